@@ -0,0 +1,330 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from aiohttp import web
+from eth_abi import abi
+from web3 import Web3
+from abi_data import gmx_abi, staked_gmx_tracker_abi, gmx_vester_abi
+from call_plan import encode_calls
+from collector import StreamingCSVSink
+from decoding import decode_uint256_rows
+from rpc import AsyncBatchTransport, BatchTransport
+from rpc_replay import start_local_server
+from main import (
+    ACCOUNT_COLUMNS,
+    CALLS_PER_ACCOUNT,
+    PAIR_CALLS_PER_ACCOUNT,
+    TRANSFER_EVENT_SIGNATURE,
+    GMX_AVALANCHE,
+    GMX_AVALANCHE_DEPLOYMENT_BLOCK,
+    build_account_call_plan,
+    build_account_columns,
+    choose_network,
+    create_log_filter_params,
+    decode_try_aggregate,
+    divide_into_chunks,
+    extract_to_addresses,
+    scale_account_columns,
+)
+
+# Run with: python benchmarks.py [benchmark ...] [--save-baseline]
+STUB_LATENCY = 0.05
+EXECUTOR_REQUESTS = 2000
+EXECUTOR_WORKERS = 4
+CALLDATA_ACCOUNTS = 2000
+HOT_PATH_ACCOUNTS = 56_000
+HOT_PATH_LOGS = 3_000_000
+HOT_PATH_BATCH_SIZE = 200
+COLLECTOR_SIZES = [10_000, 100_000, 1_000_000, 2_000_000]
+CHUNK_SPAN = 40_000_000
+CHUNK_SIZE = 15
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+REGRESSION_TOLERANCE = 0.25
+
+
+def start_stub_rpc_server(latency=STUB_LATENCY, port=0):
+    # Local JSON-RPC endpoint that answers every request with an empty result after
+    # a fixed delay, so only the client side is measured. Returns (url, stop).
+    async def handle(request):
+        body = await request.json()
+        await asyncio.sleep(latency)
+        items = body if isinstance(body, list) else [body]
+        response = [{"jsonrpc": "2.0", "id": item["id"], "result": []} for item in items]
+        return web.json_response(response if isinstance(body, list) else response[0])
+
+    return start_local_server(handle, port)
+
+
+def benchmark_filters(count):
+    start_block = GMX_AVALANCHE_DEPLOYMENT_BLOCK
+    return [create_log_filter_params([GMX_AVALANCHE], start_block + i * 10000, start_block + i * 10000 + 9999, TRANSFER_EVENT_SIGNATURE) for i in range(count)]
+
+
+def run_thread_pool(url, filters, workers=EXECUTOR_WORKERS, pooled=False):
+    # The previous executors: a fixed pool of blocking workers, one request each, on a
+    # new connection per request unless pooled keeps one session per worker
+    worker_state = threading.local()
+
+    def fetch(filter_params):
+        if not pooled:
+            return BatchTransport(url, max_batch_size=1).make_request("eth_getLogs", [filter_params])
+        if not hasattr(worker_state, "transport"):
+            worker_state.transport = BatchTransport(url, max_batch_size=1)
+        return worker_state.transport.make_request("eth_getLogs", [filter_params])
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(fetch, filters))
+
+
+async def run_async_engine(url, filters):
+    async with AsyncBatchTransport(url, max_batch_size=1) as transport:
+        return await asyncio.gather(*(transport.make_request("eth_getLogs", [filter_params]) for filter_params in filters))
+
+
+def benchmark_executors():
+    url, stop = start_stub_rpc_server()
+    filters = benchmark_filters(EXECUTOR_REQUESTS)
+    try:
+        start = time.perf_counter()
+        run_thread_pool(url, filters)
+        pool_elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        run_thread_pool(url, filters, pooled=True)
+        pooled_elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        asyncio.run(run_async_engine(url, filters))
+        async_elapsed = time.perf_counter() - start
+    finally:
+        stop()
+
+    print(f"executors: {len(filters)} eth_getLogs at {STUB_LATENCY * 1000:.0f}ms latency")
+    print(f"  {f'thread pool ({EXECUTOR_WORKERS} workers)':<24} {pool_elapsed:8.2f}s  {len(filters) / pool_elapsed:10.1f} req/s")
+    print(f"  {'thread pool, pooled':<24} {pooled_elapsed:8.2f}s  {len(filters) / pooled_elapsed:10.1f} req/s")
+    print(f"  {'asyncio engine':<24} {async_elapsed:8.2f}s  {len(filters) / async_elapsed:10.1f} req/s  ({pool_elapsed / async_elapsed:.1f}x)")
+
+
+def synthetic_accounts(count):
+    return [Web3.to_checksum_address(f"0x{i * 2654435761 % 2**160:040x}") for i in range(1, count + 1)]
+
+
+def encode_calls_with_web3(accounts, contract_addresses, helper_contracts):
+    # The per-account encodeABI calls the account fetch used before call plans
+    web3 = Web3()
+    gmx = web3.eth.contract(address=contract_addresses[0], abi=gmx_abi)
+    staked_gmx_tracker = web3.eth.contract(address=helper_contracts[0], abi=staked_gmx_tracker_abi)
+    esgmx = web3.eth.contract(address=helper_contracts[1], abi=gmx_abi)
+    glp = web3.eth.contract(address=contract_addresses[3], abi=gmx_abi)
+    staked_fee_gmx_tracker = web3.eth.contract(address=helper_contracts[2], abi=staked_gmx_tracker_abi)
+    bonus_gmx_tracker = web3.eth.contract(address=helper_contracts[3], abi=staked_gmx_tracker_abi)
+    gmx_vester = web3.eth.contract(address=helper_contracts[4], abi=gmx_vester_abi)
+    glp_vester = web3.eth.contract(address=helper_contracts[5], abi=gmx_vester_abi)
+
+    calls = []
+    for account in accounts:
+        calls.extend([
+            {"target": contract_addresses[0], "callData": gmx.encodeABI(fn_name="balanceOf", args=[account])},
+            {"target": helper_contracts[0], "callData": staked_gmx_tracker.encodeABI(fn_name="depositBalances", args=[account, contract_addresses[0]])},
+            {"target": helper_contracts[1], "callData": esgmx.encodeABI(fn_name="balanceOf", args=[account])},
+            {"target": helper_contracts[0], "callData": staked_gmx_tracker.encodeABI(fn_name="depositBalances", args=[account, helper_contracts[1]])},
+            {"target": helper_contracts[3], "callData": bonus_gmx_tracker.encodeABI(fn_name="claimable", args=[account])},
+            {"target": helper_contracts[2], "callData": staked_fee_gmx_tracker.encodeABI(fn_name="stakedAmounts", args=[account])},
+            {"target": contract_addresses[3], "callData": glp.encodeABI(fn_name="balanceOf", args=[account])},
+            {"target": helper_contracts[4], "callData": gmx_vester.encodeABI(fn_name="getMaxVestableAmount", args=[account])},
+            {"target": helper_contracts[5], "callData": glp_vester.encodeABI(fn_name="getMaxVestableAmount", args=[account])},
+        ])
+    return calls
+
+
+def benchmark_calldata():
+    _, _, contract_addresses, helper_contracts, _ = choose_network()
+    accounts = synthetic_accounts(CALLDATA_ACCOUNTS)
+
+    start = time.perf_counter()
+    web3_calls = encode_calls_with_web3(accounts, contract_addresses, helper_contracts)
+    web3_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    plan_calls = encode_calls(build_account_call_plan(contract_addresses, helper_contracts), accounts)
+    plan_elapsed = time.perf_counter() - start
+
+    if [call["callData"] for call in web3_calls] != ["0x" + call_data.hex() for _, call_data in plan_calls]:
+        raise AssertionError("call plan calldata differs from encodeABI")
+
+    print(f"calldata: {len(accounts)} accounts, {len(plan_calls)} calls")
+    print(f"  {'encodeABI':<24} {web3_elapsed:8.3f}s  {len(plan_calls) / web3_elapsed:10.0f} calls/s")
+    print(f"  {'call plan':<24} {plan_elapsed:8.3f}s  {len(plan_calls) / plan_elapsed:10.0f} calls/s  ({web3_elapsed / plan_elapsed:.0f}x)")
+
+
+def measure(fn, *args):
+    # Wall time of one run, then peak traced allocations of a second one, since
+    # tracing slows the code down. Returns (elapsed, peak_bytes).
+    start = time.perf_counter()
+    fn(*args)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    fn(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def report(name, count, unit, elapsed, peak):
+    print(f"  {name:<24} {elapsed:8.3f}s  {count / elapsed:12.0f} {unit}/s  {peak / 2**20:9.1f} MiB peak")
+    return {name: {"throughput": count / elapsed, "peak_bytes": peak}}
+
+
+def synthetic_transfer_logs(count, accounts):
+    # eth_getLogs-shaped Transfer logs cycling through the accounts as recipients.
+    # Logs to the same recipient share one topics list so millions fit in memory.
+    words = ["0x" + "0" * 24 + account[2:].lower() for account in accounts]
+    topics = [[TRANSFER_EVENT_SIGNATURE, words[(i * 7919) % len(words)], word] for i, word in enumerate(words)]
+    data = "0x" + f"{10**18:064x}"
+    return [{"address": GMX_AVALANCHE.lower(), "blockNumber": hex(GMX_AVALANCHE_DEPLOYMENT_BLOCK + i // 8), "logIndex": hex(i % 8), "topics": topics[i % len(topics)], "data": data} for i in range(count)]
+
+
+def synthetic_try_aggregate_results(account_count, batch_size, calls_per_account):
+    # Hex eth_call results of tryAggregate over batch_size accounts at a time
+    rng = np.random.default_rng(0)
+    results = []
+    for start in range(0, account_count, batch_size):
+        values = rng.integers(0, 2**63, min(batch_size, account_count - start) * calls_per_account)
+        encoded = abi.encode(["(bool,bytes)[]"], [[(True, int(value).to_bytes(32, "big")) for value in values]])
+        results.append("0x" + encoded.hex())
+    return results
+
+
+def decode_account_results(results, pair_results):
+    # The decoding fetch_accounts_data does for each batch
+    for result, pair_result in zip(results, pair_results):
+        return_data = decode_try_aggregate(result)
+        decode_uint256_rows(return_data, CALLS_PER_ACCOUNT)
+        pair_return_data = decode_try_aggregate(pair_result)
+        decode_uint256_rows(pair_return_data, PAIR_CALLS_PER_ACCOUNT)
+
+
+def assemble_account_csv(accounts, values, pair_values, directory):
+    # Batch columns through the streaming sink into the scaled output CSV, as __main__ does
+    sink = StreamingCSVSink(os.path.join(directory, "gmx_accounts_benchmark.csv"), ACCOUNT_COLUMNS, transform=scale_account_columns)
+    for start in range(0, len(accounts), HOT_PATH_BATCH_SIZE):
+        end = start + HOT_PATH_BATCH_SIZE
+        sink.add_batch(build_account_columns(accounts[start:end], values[start:end], pair_values[start:end]))
+    sink.close(accounts)
+
+
+def collect_with_sink(accounts, values, pair_values, batch_starts, directory):
+    # Raw-unit batches through build_account_columns and the streaming sink, arriving in batch_starts order
+    sink = StreamingCSVSink(os.path.join(directory, "gmx_accounts_benchmark.csv"), ACCOUNT_COLUMNS, transform=scale_account_columns)
+    for start in batch_starts:
+        end = start + HOT_PATH_BATCH_SIZE
+        sink.add_batch(build_account_columns(accounts[start:end], values[start:end], pair_values[start:end]))
+    sink.close(accounts)
+
+
+def benchmark_collector():
+    # Collecting results must stay linear in the number of accounts; memory holds
+    # the sink's flush buffer and the set of written accounts, never the table
+    print(f"collector: batches of {HOT_PATH_BATCH_SIZE} accounts in random completion order")
+    rng = np.random.default_rng(0)
+    for count in COLLECTOR_SIZES:
+        accounts = [f"0x{i:040x}" for i in range(count)]
+        values = rng.integers(0, 2**63, (count, CALLS_PER_ACCOUNT)).astype(float)
+        pair_values = rng.integers(0, 2**63, (count, PAIR_CALLS_PER_ACCOUNT)).astype(float)
+        batch_starts = rng.permutation(np.arange(0, count, HOT_PATH_BATCH_SIZE)).tolist()
+        with tempfile.TemporaryDirectory() as directory:
+            elapsed, peak = measure(collect_with_sink, accounts, values, pair_values, batch_starts, directory)
+        print(f"  {'StreamingCSVSink':<18} {count:>9} accounts {elapsed:8.3f}s  {elapsed / count * 1e6:8.2f}us/account  {peak / 2**20:9.1f} MiB peak")
+
+
+def benchmark_hot_paths():
+    accounts = synthetic_accounts(HOT_PATH_ACCOUNTS)
+    print(f"hot paths: {len(accounts)} accounts, {HOT_PATH_LOGS} Transfer logs")
+    results = {}
+
+    logs = synthetic_transfer_logs(HOT_PATH_LOGS, accounts)
+    results.update(report("extract_to_addresses", len(logs), "logs", *measure(extract_to_addresses, logs)))
+    del logs
+
+    account_results = synthetic_try_aggregate_results(len(accounts), HOT_PATH_BATCH_SIZE, CALLS_PER_ACCOUNT)
+    pair_results = synthetic_try_aggregate_results(len(accounts), HOT_PATH_BATCH_SIZE, PAIR_CALLS_PER_ACCOUNT)
+    results.update(report("decode results", len(accounts), "accounts", *measure(decode_account_results, account_results, pair_results)))
+    del account_results, pair_results
+
+    ranges = len(divide_into_chunks(GMX_AVALANCHE_DEPLOYMENT_BLOCK, GMX_AVALANCHE_DEPLOYMENT_BLOCK + CHUNK_SPAN, CHUNK_SIZE))
+    results.update(report("divide_into_chunks", ranges, "ranges", *measure(divide_into_chunks, GMX_AVALANCHE_DEPLOYMENT_BLOCK, GMX_AVALANCHE_DEPLOYMENT_BLOCK + CHUNK_SPAN, CHUNK_SIZE)))
+
+    rng = np.random.default_rng(0)
+    values = rng.integers(0, 2**63, (len(accounts), CALLS_PER_ACCOUNT)).astype(float)
+    pair_values = rng.integers(0, 2**63, (len(accounts), PAIR_CALLS_PER_ACCOUNT)).astype(float)
+    with tempfile.TemporaryDirectory() as directory:
+        results.update(report("CSV assembly", len(accounts), "accounts", *measure(assemble_account_csv, accounts, values, pair_values, directory)))
+    return results
+
+
+def compare_with_baseline(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    # Returns a message per result whose throughput dropped or whose peak memory
+    # grew by more than tolerance against the baseline
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        expected = baseline[name]
+        if result["throughput"] < expected["throughput"] * (1 - tolerance):
+            regressions.append(f"{name}: {result['throughput']:.0f}/s against a baseline of {expected['throughput']:.0f}/s")
+        if result["peak_bytes"] > expected["peak_bytes"] * (1 + tolerance):
+            regressions.append(f"{name}: {result['peak_bytes'] / 2**20:.1f} MiB peak against a baseline of {expected['peak_bytes'] / 2**20:.1f} MiB")
+    return regressions
+
+
+BENCHMARKS = {
+    "executors": benchmark_executors,
+    "calldata": benchmark_calldata,
+    "collector": benchmark_collector,
+    "hot_paths": benchmark_hot_paths,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the snapshot pipeline")
+    parser.add_argument("benchmarks", nargs="*", metavar="benchmark", help=f"any of {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument("--save-baseline", action="store_true", help=f"store the results as the new {os.path.basename(BASELINE_PATH)}")
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.benchmarks or list(BENCHMARKS):
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name}")
+        results.update(BENCHMARKS[name]() or {})
+
+    # Benchmarks that return results are checked against the stored baseline
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(BASELINE_PATH):
+            with open(BASELINE_PATH) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(BASELINE_PATH, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"Saved {len(results)} results to {BASELINE_PATH}")
+    elif results:
+        if not os.path.exists(BASELINE_PATH):
+            print(f"No baseline at {BASELINE_PATH} to check against; run with --save-baseline to create one")
+            sys.exit(1)
+        with open(BASELINE_PATH) as f:
+            regressions = compare_with_baseline(results, json.load(f))
+        if regressions:
+            print("REGRESSIONS against " + BASELINE_PATH + ":")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"No regressions against {BASELINE_PATH}")
@@ -0,0 +1,72 @@
+import json
+import os
+
+MIN_BLOCK_RANGE = 16
+MAX_BLOCK_RANGE = 2_000_000
+TARGET_LOGS_PER_RANGE = 5000
+SIZE_BUCKET_BLOCKS = 1_000_000
+
+# Provider messages for a range that returns too much data; these are fixed by
+# splitting the range, not by retrying it
+RESULT_SIZE_ERRORS = [
+    "more than 10000 results",
+    "response size exceeded",
+    "response size should not greater than",
+    "query exceeds max results",
+    "query returned more than",
+    "block range is too wide",
+    "block range too large",
+    "exceed maximum block range",
+    "limited to a 10,000",
+    "limited to 10000",
+    "too many results",
+]
+
+
+def is_result_size_error(error):
+    message = str(error).lower()
+    return any(pattern in message for pattern in RESULT_SIZE_ERRORS)
+
+
+def range_sizes_path(network_name):
+    return f"block_range_sizes_{network_name}.json"
+
+
+def load_range_sizes(network_name):
+    # Range sizes that worked on a previous scan, keyed by SIZE_BUCKET_BLOCKS bucket
+    path = range_sizes_path(network_name)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return {int(bucket): size for bucket, size in json.load(f).items()}
+
+
+def save_range_sizes(network_name, range_sizes):
+    path = range_sizes_path(network_name)
+    with open(path + ".tmp", "w") as f:
+        json.dump({str(bucket): size for bucket, size in sorted(range_sizes.items())}, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def range_size_for(range_sizes, block, default):
+    return range_sizes.get(block // SIZE_BUCKET_BLOCKS, default)
+
+
+def record_range_size(range_sizes, start_block, size):
+    merge_range_sizes(range_sizes, {start_block // SIZE_BUCKET_BLOCKS: size})
+
+
+def merge_range_sizes(range_sizes, new_sizes):
+    for bucket, size in new_sizes.items():
+        range_sizes[bucket] = max(range_sizes.get(bucket, 0), size)
+    return range_sizes
+
+
+def next_range_size(size, largest_result, hit_size_limit):
+    if hit_size_limit:
+        return max(MIN_BLOCK_RANGE, size // 2)
+    if largest_result < TARGET_LOGS_PER_RANGE // 2:
+        return min(MAX_BLOCK_RANGE, size * 2)
+    if largest_result > TARGET_LOGS_PER_RANGE:
+        return max(MIN_BLOCK_RANGE, size // 2)
+    return size
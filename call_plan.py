@@ -0,0 +1,46 @@
+from eth_utils import keccak
+
+
+def canonical_type(arg):
+    # Struct arguments appear as tuple types; the signature spells out their components
+    if arg["type"].startswith("tuple"):
+        return f"({','.join(canonical_type(component) for component in arg['components'])}){arg['type'][len('tuple'):]}"
+    return arg["type"]
+
+
+def function_selector(contract_abi, fn_name):
+    for item in contract_abi:
+        if item.get("type") == "function" and item["name"] == fn_name:
+            signature = f"{fn_name}({','.join(canonical_type(arg) for arg in item['inputs'])})"
+            return keccak(text=signature)[:4]
+    raise ValueError(f"Function {fn_name} not found in ABI")
+
+
+def address_word(address):
+    return bytes(12) + bytes.fromhex(address[2:])
+
+
+def uint_word(value):
+    return value.to_bytes(32, "big")
+
+
+class CallTemplate:
+    # One multicall entry whose first argument is the account. The selector and the
+    # words for any static arguments after it are encoded once; per account only the
+    # padded address (and any per-account trailing words) are joined in.
+
+    def __init__(self, target, contract_abi, fn_name, static_args=()):
+        self.target = target
+        self.selector = function_selector(contract_abi, fn_name)
+        self.suffix = b"".join(address_word(arg) if isinstance(arg, str) else uint_word(arg) for arg in static_args)
+
+    def encode(self, account_word, *value_words):
+        return (self.target, b"".join((self.selector, account_word, self.suffix, *value_words)))
+
+
+def encode_calls(plan, accounts):
+    calls = []
+    for account in accounts:
+        account_word = address_word(account)
+        calls.extend(template.encode(account_word) for template in plan)
+    return calls
@@ -0,0 +1,76 @@
+import glob
+import os
+import re
+import time
+import pandas as pd
+
+FLUSH_ROWS = 10_000
+FLUSH_SECONDS = 30
+
+
+def find_partial_output(network_name):
+    # Newest unfinished gmx_accounts_<network>_<block>.csv.partial, as (block, path)
+    outputs = []
+    for path in glob.glob(f"gmx_accounts_{network_name}_*.csv.partial"):
+        match = re.fullmatch(rf"gmx_accounts_{network_name}_(\d+)\.csv\.partial", os.path.basename(path))
+        if match:
+            outputs.append((int(match.group(1)), path))
+    return max(outputs) if outputs else None
+
+
+def truncate_to_last_line(path):
+    # Drops a row left half-written by a hard crash so appends start on a fresh line
+    with open(path, "rb+") as f:
+        data = f.read()
+        f.truncate(data.rfind(b"\n") + 1)
+
+
+class StreamingCSVSink:
+    # Appends batch results to <path>.partial as they arrive, flushing once max_rows
+    # rows are buffered or max_interval seconds have passed, so memory stays bounded
+    # by the buffer and readers can follow the partial file. close() appends empty
+    # rows for accounts that never arrived and renames the file to path.
+    #
+    # The partial file doubles as the journal of completed accounts for its snapshot
+    # block: an existing one is replayed into written and appended to, so a restarted
+    # run only fetches the accounts not in it.
+
+    def __init__(self, path, columns, transform=None, max_rows=FLUSH_ROWS, max_interval=FLUSH_SECONDS):
+        self.path = path
+        self.partial_path = path + ".partial"
+        self.columns = columns
+        self.transform = transform
+        self.max_rows = max_rows
+        self.max_interval = max_interval
+        self.buffer = []
+        self.buffered_rows = 0
+        self.written = set()
+        self.last_flush = time.monotonic()
+        if os.path.exists(self.partial_path):
+            truncate_to_last_line(self.partial_path)
+            self.written.update(pd.read_csv(self.partial_path, usecols=["account"])["account"])
+        else:
+            pd.DataFrame(columns=columns).to_csv(self.partial_path, index=False)
+
+    def add_batch(self, columns):
+        self.buffer.append(pd.DataFrame(columns, columns=self.columns))
+        self.buffered_rows += len(columns["account"])
+        if self.buffered_rows >= self.max_rows or time.monotonic() - self.last_flush >= self.max_interval:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            df = pd.concat(self.buffer, ignore_index=True)
+            if self.transform is not None:
+                df = self.transform(df)
+            df.to_csv(self.partial_path, mode="a", header=False, index=False)
+            self.written.update(df["account"])
+            self.buffer = []
+            self.buffered_rows = 0
+        self.last_flush = time.monotonic()
+
+    def close(self, accounts):
+        self.flush()
+        missing = [account for account in accounts if account not in self.written]
+        pd.DataFrame({"account": missing}, columns=self.columns).to_csv(self.partial_path, mode="a", header=False, index=False)
+        os.replace(self.partial_path, self.path)
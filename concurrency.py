@@ -0,0 +1,87 @@
+import asyncio
+import time
+
+INITIAL_CONCURRENCY = 8
+MIN_CONCURRENCY = 1
+DECREASE_FACTOR = 0.5
+LATENCY_TOLERANCE = 2.0
+SHORT_LATENCY_WEIGHT = 0.2
+LONG_LATENCY_WEIGHT = 0.01
+BASE_BACKOFF = 0.5
+MAX_BACKOFF = 30
+
+
+class ConcurrencyController:
+    # AIMD limit on requests in flight, shared by every transport of a run so the
+    # account fetch starts from what the log scan learned. Each success while latency
+    # stays near its long-run average adds about one slot per round trip; a throttle
+    # or timeout halves the limit (once per round trip) and pauses new requests for
+    # Retry-After or an exponential backoff.
+
+    def __init__(self, max_limit, initial_limit=INITIAL_CONCURRENCY, min_limit=MIN_CONCURRENCY):
+        self.limit = float(min(initial_limit, max_limit))
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.in_flight = 0
+        self.short_latency = None
+        self.long_latency = None
+        self.paused_until = 0.0
+        self.backoff = BASE_BACKOFF
+        self.last_decrease = 0.0
+        self._condition = None
+
+    def bind(self):
+        # asyncio primitives belong to one event loop, so each stage's loop gets its own
+        self._condition = asyncio.Condition()
+        self.in_flight = 0
+
+    def is_paused(self):
+        return self.paused_until > time.monotonic()
+
+    def has_capacity(self):
+        return not self.is_paused() and self.in_flight < int(self.limit)
+
+    async def acquire(self):
+        while True:
+            delay = self.paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            async with self._condition:
+                if self.in_flight < int(self.limit) and self.paused_until <= time.monotonic():
+                    self.in_flight += 1
+                    return
+                await self._condition.wait()
+
+    async def release(self, latency, throttled=False, retry_after=None):
+        async with self._condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                self._decrease(now)
+                self.paused_until = max(self.paused_until, now + (retry_after if retry_after is not None else self.backoff))
+                self.backoff = min(MAX_BACKOFF, self.backoff * 2)
+            else:
+                self.backoff = BASE_BACKOFF
+                if self._observe_latency(latency):
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+            slots = int(self.limit) - self.in_flight
+            if slots > 0:
+                self._condition.notify(slots)
+
+    def _observe_latency(self, latency):
+        # Returns whether latency is healthy: the recent average within
+        # LATENCY_TOLERANCE of the long-run one
+        if self.short_latency is None:
+            self.short_latency = self.long_latency = latency
+            return True
+        self.short_latency += SHORT_LATENCY_WEIGHT * (latency - self.short_latency)
+        self.long_latency += LONG_LATENCY_WEIGHT * (latency - self.long_latency)
+        return self.short_latency <= LATENCY_TOLERANCE * self.long_latency
+
+    def _decrease(self, now):
+        # Failures from the same round trip only count once
+        if now - self.last_decrease >= (self.short_latency or 0):
+            self.limit = max(self.min_limit, self.limit * DECREASE_FACTOR)
+            self.last_decrease = now
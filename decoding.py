@@ -0,0 +1,63 @@
+import numpy as np
+from eth_abi import abi
+
+# Weights of the four big-endian 64-bit limbs of a uint256 word
+LIMB_WEIGHTS = np.array([2.0**192, 2.0**128, 2.0**64, 1.0])
+
+
+def decode_uint256_words(return_data):
+    # Decodes the leading uint256 of every return value in one pass over the joined
+    # 32-byte words. Returns the values as float64 and a mask of which calls returned
+    # a word; failed calls decode as 0.
+    ok = np.fromiter((data is not None and len(data) >= 32 for data in return_data), dtype=bool, count=len(return_data))
+    buffer = b"".join(data[:32] if good else bytes(32) for data, good in zip(return_data, ok))
+    limbs = np.frombuffer(buffer, dtype=">u8").reshape(-1, 4)
+    return limbs @ LIMB_WEIGHTS, ok
+
+
+def small_words(words, values):
+    # Mask of the (n, 4) limb rows that equal values (one per row, or a scalar) as uint256
+    return (words[:, :3] == 0).all(axis=1) & (words[:, 3] == values)
+
+
+def decode_try_aggregate_with_abi(payload):
+    return [data if success and data else None for success, data in abi.decode(["(bool,bytes)[]"], payload)[0]]
+
+
+def decode_try_aggregate_return(payload):
+    # Return data per call from a tryAggregate (bool,bytes)[] response, None for
+    # calls that failed. Each entry returning one word has a fixed layout (success,
+    # offset 0x40, length 0x20, value), so their head words are checked in one
+    # vectorised pass and the values sliced out; only entries that differ, such as
+    # reverts carrying a reason, are decoded with eth_abi.
+    if len(payload) % 32 or len(payload) < 64:
+        return decode_try_aggregate_with_abi(payload)
+    words = np.frombuffer(payload, dtype=">u8").reshape(-1, 4)
+    count = int(words[1, 3])
+    if not small_words(words[:2], np.array([0x20, count])).all() or count + 2 > len(words):
+        return decode_try_aggregate_with_abi(payload)
+    # Entry offsets count from the start of the array body, right after its length word
+    offsets = words[2 : 2 + count, 3]
+    in_bounds = small_words(words[2 : 2 + count], offsets) & (offsets <= max(len(payload) - 64 - 96, 0))
+    starts = np.where(in_bounds, offsets, 0).astype(np.int64) + 64
+    rows = starts // 32
+    successes = words[rows, 3]
+    fits = in_bounds & (starts % 32 == 0) & (rows + 4 <= len(words)) & small_words(words[rows], successes) & (successes <= 1) & small_words(words[rows + 1], 0x40) & small_words(words[rows + 2], 0x20)
+
+    return_data = []
+    for start, fit, success, bounded in zip(starts.tolist(), fits.tolist(), successes.tolist(), in_bounds.tolist()):
+        if fit:
+            return_data.append(payload[start + 96 : start + 128] if success else None)
+        elif bounded:
+            success, data = abi.decode(["bool", "bytes"], payload[start:])
+            return_data.append(data if success and data else None)
+        else:
+            raise ValueError("tryAggregate result offset out of range")
+    return return_data
+
+
+def decode_uint256_rows(return_data, width):
+    # Same as decode_uint256_words for a batch laid out as width calls per row.
+    # Returns a (rows, width) value matrix and a per-row mask of fully successful rows.
+    values, ok = decode_uint256_words(return_data)
+    return values.reshape(-1, width), ok.reshape(-1, width).all(axis=1)
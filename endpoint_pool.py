@@ -0,0 +1,155 @@
+import asyncio
+import itertools
+import random
+import time
+from collections import deque
+from metrics import METRICS
+
+LATENCY_WINDOW = 200
+MIN_LATENCY_SAMPLES = 20
+DEFAULT_LATENCY = 0.5
+ERROR_RATE_WEIGHT = 0.05
+HEDGE_PERCENTILE = 0.95
+MIN_HEDGE_DELAY = 0.05
+
+
+class Endpoint:
+    def __init__(self, transport):
+        self.transport = transport
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.error_rate = 0.0
+
+    def record(self, latency, ok):
+        if ok:
+            self.latencies.append(latency)
+        self.error_rate += ERROR_RATE_WEIGHT * ((0.0 if ok else 1.0) - self.error_rate)
+
+    def latency_percentile(self, percentile):
+        if len(self.latencies) < MIN_LATENCY_SAMPLES:
+            return DEFAULT_LATENCY
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(percentile * len(ordered)))]
+
+    def score(self):
+        # Requests per second it would serve at its median latency, discounted by errors
+        return (1.0 - self.error_rate) ** 2 / max(self.latency_percentile(0.5), 1e-3)
+
+    def hedge_delay(self):
+        return max(MIN_HEDGE_DELAY, self.latency_percentile(HEDGE_PERCENTILE))
+
+
+class EndpointPool:
+    # Spreads batches over several transports for the same chain, picking each one
+    # with probability proportional to its score and skipping endpoints whose
+    # controller is backing off. A batch still unanswered the endpoint's p95
+    # latency after it went out (time spent in the controller queue does not
+    # count) is sent again to another endpoint with spare capacity, and the first
+    # good answer wins. A batch whose endpoint fails
+    # goes to another one at once.
+
+    def __init__(self, transports):
+        self.endpoints = [Endpoint(transport) for transport in transports]
+        self.max_batch_size = min(transport.max_batch_size for transport in transports)
+        self.hedged_requests = 0
+
+    async def __aenter__(self):
+        for endpoint in self.endpoints:
+            await endpoint.transport.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        for endpoint in self.endpoints:
+            await endpoint.transport.__aexit__(*exc_info)
+
+    async def make_request(self, method, params):
+        result = (await self.make_batch_request([(method, params)]))[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    async def make_batch_request(self, calls):
+        chunks = [calls[i : i + self.max_batch_size] for i in range(0, len(calls), self.max_batch_size)]
+        results = await asyncio.gather(*(self.post_batch(chunk) for chunk in chunks))
+        return list(itertools.chain.from_iterable(results))
+
+    def choose_endpoint(self, exclude=()):
+        candidates = [endpoint for endpoint in self.endpoints if endpoint not in exclude]
+        available = [endpoint for endpoint in candidates if not endpoint.transport.controller.is_paused()]
+        candidates = available or candidates
+        if not candidates:
+            return None
+        return random.choices(candidates, weights=[endpoint.score() for endpoint in candidates])[0]
+
+    async def _post_to(self, endpoint, calls, sent=None):
+        # Latency is measured from when the request left the endpoint's controller
+        # queue; that time is also set on the sent future, if given
+        sent_at = None
+
+        def mark_sent():
+            nonlocal sent_at
+            sent_at = time.monotonic()
+            if sent is not None and not sent.done():
+                sent.set_result(sent_at)
+
+        try:
+            results = await endpoint.transport.post_batch(calls, on_sent=mark_sent)
+        except asyncio.CancelledError:
+            # A hedge loser is at least as slow as the time it was given
+            if sent_at is not None:
+                endpoint.record(time.monotonic() - sent_at, True)
+            raise
+        except Exception:
+            endpoint.record(time.monotonic() - (sent_at or time.monotonic()), False)
+            raise
+        endpoint.record(time.monotonic() - sent_at, True)
+        return results
+
+    async def post_batch(self, calls):
+        primary = self.choose_endpoint()
+        sent = asyncio.get_running_loop().create_future()
+        tasks = {asyncio.ensure_future(self._post_to(primary, calls, sent))}
+        used = [primary]
+        # Only the primary can be hedged, and only while another endpoint is left to take it
+        hedging = True
+        hedge_at = None
+        error = None
+        try:
+            while tasks:
+                waiting = tasks
+                timeout = None
+                if hedging:
+                    # The hedge clock starts once the primary request is actually sent
+                    if sent.done():
+                        if hedge_at is None:
+                            hedge_at = sent.result() + primary.hedge_delay()
+                        timeout = max(0.0, hedge_at - time.monotonic())
+                    else:
+                        waiting = tasks | {sent}
+                done, _ = await asyncio.wait(waiting, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                done.discard(sent)
+                tasks -= done
+                if not done and timeout is None:
+                    continue
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+
+                backup = self.choose_endpoint(exclude=used)
+                if backup is None:
+                    hedging = False
+                    continue
+                if not done:
+                    # Hedge only into spare capacity, never behind another endpoint's queue
+                    if not backup.transport.controller.has_capacity():
+                        hedge_at = time.monotonic() + primary.hedge_delay()
+                        continue
+                    self.hedged_requests += 1
+                    METRICS.inc("rpc_hedged_batches_total")
+                tasks.add(asyncio.ensure_future(self._post_to(backup, calls)))
+                used.append(backup)
+                hedging = False
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
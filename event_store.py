@@ -0,0 +1,63 @@
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS transfers (
+    block INTEGER NOT NULL,
+    tx_index INTEGER NOT NULL,
+    log_index INTEGER NOT NULL,
+    token TEXT NOT NULL,
+    from_address TEXT NOT NULL,
+    to_address TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (block, log_index)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS transfers_from_address ON transfers (from_address, block);
+CREATE INDEX IF NOT EXISTS transfers_to_address ON transfers (to_address, block);
+"""
+
+
+def event_store_path(network_name):
+    return f"transfers_{network_name}.sqlite"
+
+
+def open_event_store(path):
+    # scan_logs shares one connection between its workers; WAL with synchronous=NORMAL
+    # keeps its many small commits cheap and lets readers in while it writes
+    conn = sqlite3.connect(path, timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def decode_transfer_log(log):
+    # Addresses are kept as lowercase hex and values as decimal text, since uint256
+    # does not fit an SQLite integer
+    topics = log["topics"]
+    data = log["data"]
+    return (
+        int(log["blockNumber"], 16),
+        int(log["transactionIndex"], 16),
+        int(log["logIndex"], 16),
+        log["address"].lower(),
+        "0x" + topics[1][-40:].lower(),
+        "0x" + topics[2][-40:].lower(),
+        str(int(data, 16)) if data != "0x" else "0",
+    )
+
+
+def insert_transfer_logs(conn, logs):
+    with conn:
+        conn.executemany("INSERT OR IGNORE INTO transfers VALUES (?, ?, ?, ?, ?, ?, ?)", (decode_transfer_log(log) for log in logs if len(log["topics"]) >= 3))
+
+
+def query_to_addresses(conn, from_block=0):
+    return [row[0] for row in conn.execute("SELECT DISTINCT to_address FROM transfers WHERE block >= ?", (from_block,))]
+
+
+def query_account_transfers(conn, account, from_block=0):
+    account = account.lower()
+    return conn.execute(
+        "SELECT * FROM transfers WHERE from_address = ? AND block >= ? UNION ALL SELECT * FROM transfers WHERE to_address = ? AND block >= ? ORDER BY block, log_index",
+        (account, from_block, account, from_block),
+    ).fetchall()
@@ -1,14 +1,33 @@
 from web3 import Web3
 import pandas as pd
-from multiprocessing import Pool
-from tqdm.contrib.concurrent import process_map
+import numpy as np
+import argparse
+import asyncio
+import atexit
 import itertools
+import os
+import shutil
+import time
 from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from eth_abi import abi
+from eth_utils import keccak
 from abi_data import gmx_abi, staked_gmx_tracker_abi, gmx_vester_abi, multicall_abi
+from collector import StreamingCSVSink, find_partial_output
+from decoding import decode_try_aggregate_return, decode_uint256_rows
+from call_plan import CallTemplate, address_word, encode_calls, function_selector, uint_word
+from concurrency import ConcurrencyController
+from endpoint_pool import EndpointPool
+from rpc import AsyncBatchTransport, DEFAULT_BATCH_LIMIT, MAX_IN_FLIGHT_REQUESTS, RPCError, create_http_session
+from scan_checkpoint import load_scan_checkpoint, save_scan_checkpoint
+from event_store import event_store_path, insert_transfer_logs, open_event_store
+from retry import RetryPolicy
+from response_cache import CachedTransport, ResponseCache, response_cache_path
+from metrics import METRICS, METRICS_INTERVAL, serve_prometheus, start_metrics_file
+from profiling import StageProfiler
+from tracing import TRACER
+from rpc_replay import RPCRecorder, load_recording, start_recording_proxy, start_replay_server
+from block_ranges import SIZE_BUCKET_BLOCKS, is_result_size_error, load_range_sizes, merge_range_sizes, next_range_size, range_size_for, record_range_size, save_range_sizes
 import logging
-import time
 
 GMX_ARBITRUM = "0xfc5A1A6EB076a2C7aD06eD22C90d7E710E35ad0a"
 ESGMX_ARBITRUM = "0xf42Ae1D54fd613C9bb14810b0588FaAa09a426cA"
@@ -38,10 +57,43 @@ GMX_AVALANCHE_DEPLOYMENT_BLOCK = 8352150
 
 
 TRANSFER_EVENT_SIGNATURE = "0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef"
+TRY_AGGREGATE_SELECTOR = function_selector(multicall_abi, "tryAggregate")
 BLOCK_RANGE_LIMIT = 9999
-NUM_PROCESSES = 4
+SCAN_SEGMENTS = 256
+SCAN_CHECKPOINT_SECONDS = 60
+FINALITY_DEPTH = 64
+MAX_CONCURRENT_ACCOUNT_BATCHES = 64
+CALLS_PER_ACCOUNT = 9
+PAIR_CALLS_PER_ACCOUNT = 2
+ETH_CALL_GAS_CAP = 50_000_000
+MAX_RESPONSE_BYTES = 5_000_000
+BATCH_GAS_HEADROOM = 0.8
+DEFAULT_GAS_PER_CALL = 30_000
+MAX_ACCOUNT_BATCH_SIZE = 1000
+# Node messages for an aggregate that is too big to execute or return; these are
+# fixed by splitting the batch, not by retrying it
+AGGREGATE_SIZE_ERRORS = [
+    "out of gas",
+    "gas required exceeds",
+    "exceeds block gas limit",
+    "gas limit reached",
+    "gas cap",
+    "execution aborted",
+    "response size exceeded",
+    "response too large",
+    "max response size",
+]
 RPC_ARBITRUM = "https://arb-mainnet.g.alchemy.com/v2/gv37D3QuLk_vT2N2opLgMt7I7MM24aRO"
+RPC_ARBITRUM_PUBLIC = "https://arb1.arbitrum.io/rpc"
 RPC_AVALANCHE = "https://avalanche-mainnet.infura.io/v3/0f3da4bda8514421b1952d7129074aca"
+RPC_AVALANCHE_PUBLIC = "https://api.avax.network/ext/bc/C/rpc"
+ACCOUNT_COLUMNS = ["account", "GMX in wallet", "GMX staked", "esGMX in wallet", "esGMX staked", "GLP in wallet", "GLP staked", "MP in wallet", "MP staked", "esGMX earned from GMX/esGMX/MPs", "GMX needed to vest", "esGMX earned from GLP", "GLP needed to vest"]
+RPC_BATCH_LIMITS = {
+    RPC_ARBITRUM: 50,
+    RPC_ARBITRUM_PUBLIC: 10,
+    RPC_AVALANCHE: 20,
+    RPC_AVALANCHE_PUBLIC: 10,
+}
 
 
 def choose_network():
@@ -53,7 +105,7 @@ def choose_network():
     #     if choice == "1":
     #         return (
     #             "arbitrum",
-    #             RPC_ARBITRUM,
+    #             [RPC_ARBITRUM, RPC_ARBITRUM_PUBLIC],
     #             [GMX_ARBITRUM, GLP_ARBITRUM, SGMX_ARBITRUM, SGLP_ARBITRUM],
     #             [STAKED_GMX_TRACKER_ARBITRUM,ESGMX_ARBITRUM,FEE_GMX_TRACKER_ARBITRUM,BONUS_GMX_TRACKER_ARBITRUM,GMX_VESTER_ARBITRUM,GLP_VESTER_ARBITRUM,MULTICALL_ARBITRUM],
     #             GMX_ARBITRUM_DEPLOYMENT_BLOCK,
@@ -61,7 +113,7 @@ def choose_network():
     #     elif choice == "2":
     #         return (
     #             "avalanche",
-    #             RPC_AVALANCHE,
+    #             [RPC_AVALANCHE, RPC_AVALANCHE_PUBLIC],
     #             [GMX_AVALANCHE, GLP_AVALANCHE, SGMX_AVALANCHE, SGLP_AVALANCHE],
     #             [STAKED_GMX_TRACKER_AVALANCHE,ESGMX_AVALANCHE,FEE_GMX_TRACKER_AVALANCHE,BONUS_GMX_TRACKER_AVALANCHE,GMX_VESTER_AVALANCHE,GLP_VESTER_AVALANCHE,MULTICALL_AVALANCHE],
     #             GMX_AVALANCHE_DEPLOYMENT_BLOCK,
@@ -71,207 +123,572 @@ def choose_network():
 
     return (
         "avalanche",
-        RPC_AVALANCHE,
+        [RPC_AVALANCHE, RPC_AVALANCHE_PUBLIC],
         [GMX_AVALANCHE, GLP_AVALANCHE, SGMX_AVALANCHE, SGLP_AVALANCHE],
         [STAKED_GMX_TRACKER_AVALANCHE, ESGMX_AVALANCHE, FEE_GMX_TRACKER_AVALANCHE, BONUS_GMX_TRACKER_AVALANCHE, GMX_VESTER_AVALANCHE, GLP_VESTER_AVALANCHE, MULTICALL_AVALANCHE],
         GMX_AVALANCHE_DEPLOYMENT_BLOCK,
     )
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Snapshot GMX account balances")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--record", metavar="FILE", help="record all RPC traffic to FILE (gzipped JSON lines)")
+    mode.add_argument("--replay", metavar="FILE", help="run offline against RPC traffic recorded to FILE")
+    parser.add_argument("--replay-latency", type=float, metavar="SECONDS", help="fixed latency per replayed request instead of the recorded one")
+    parser.add_argument("--metrics-port", type=int, metavar="PORT", help="serve Prometheus metrics at http://127.0.0.1:PORT/metrics")
+    parser.add_argument("--profile", metavar="DIR", help="profile each pipeline stage and write the reports to DIR")
+    parser.add_argument("--trace", metavar="FILE", help="write a Chrome trace-event timeline of RPC requests, retry sleeps and stages to FILE")
+    parser.add_argument("--metrics-file", metavar="FILE", help=f"write metrics as JSON to FILE every {METRICS_INTERVAL} seconds")
+    args = parser.parse_args()
+    # Record and replay runs change into their own state directory, so paths are resolved first
+    for name in ("record", "replay", "profile", "trace", "metrics_file"):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+    return args
+
+
+def enter_fresh_state_dir(path):
+    # Checkpoints, range sizes, the event store and outputs are all relative to the
+    # working directory; an emptied directory of its own makes a record run and its
+    # replay start from the same state
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    os.chdir(path)
+    print(f"Running in {path}")
+
+
+def start_rpc_stand_ins(rpc_urls, args):
+    # Puts a local server in front of each endpoint: a recording proxy, or a replay
+    # server that needs no network. The local URLs keep their endpoint's batch limit.
+    if args.record:
+        recorder = RPCRecorder()
+        servers = [start_recording_proxy(rpc_url, recorder) for rpc_url in rpc_urls]
+        enter_fresh_state_dir(args.record + ".record")
+    else:
+        recording = load_recording(args.replay)
+        servers = [start_replay_server(recording, args.replay_latency) for _ in rpc_urls]
+        enter_fresh_state_dir(args.replay + ".replay")
+
+    def stop():
+        for _, stop_server in servers:
+            stop_server()
+        if args.record:
+            recorder.save(args.record)
+            print(f"Recorded {len(recorder.entries)} RPC requests to {args.record}")
+
+    atexit.register(stop)
+    for rpc_url, (local_url, _) in zip(rpc_urls, servers):
+        RPC_BATCH_LIMITS[local_url] = RPC_BATCH_LIMITS.get(rpc_url, DEFAULT_BATCH_LIMIT)
+    return [local_url for local_url, _ in servers]
+
+
 def initialize_web3_connection(rpc_url):
-    return Web3(Web3.HTTPProvider(rpc_url))
+    return Web3(Web3.HTTPProvider(rpc_url, session=create_http_session()))
 
 
-def create_log_filter_params(contract_address, start_block, end_block, event_signature):
+def create_log_filter_params(contract_addresses, start_block, end_block, event_signature):
     return {
-        "fromBlock": start_block,
-        "toBlock": end_block,
-        "address": contract_address,
+        "fromBlock": hex(start_block),
+        "toBlock": hex(end_block),
+        "address": list(contract_addresses),
         "topics": [event_signature],
     }
 
 
-def fetch_logs_for_range(args, max_retries=3, initial_wait=1):
-    range_info, rpc_url, contract_addresses = args
-    web3 = initialize_web3_connection(rpc_url)
-    start_block, end_block = range_info
-    all_logs = []
+def create_transport(rpc_url, controller=None):
+    return AsyncBatchTransport(rpc_url, max_batch_size=RPC_BATCH_LIMITS.get(rpc_url, DEFAULT_BATCH_LIMIT), max_in_flight=MAX_IN_FLIGHT_REQUESTS, controller=controller)
 
-    for address in contract_addresses:
-        retry_count = 0
-        while retry_count < max_retries:
-            try:
-                filter_params = create_log_filter_params(address, start_block, end_block, TRANSFER_EVENT_SIGNATURE)
-                logs = web3.eth.get_logs(filter_params)
-                all_logs.extend(logs)
-                break  # Break the loop if the operation is successful
-            except Exception as e:
-                logging.error(f"Error fetching logs: {e}")
-                retry_count += 1
-                time.sleep(initial_wait * 2**retry_count)  # Exponential backoff
 
-        if retry_count == max_retries:
-            logging.error(f"Failed to fetch logs after {max_retries} attempts.")
+def create_endpoint_pool(rpc_urls, controllers, cache=None):
+    pool = EndpointPool([create_transport(rpc_url, controllers[rpc_url]) for rpc_url in rpc_urls])
+    return pool if cache is None else CachedTransport(pool, cache)
+
 
-    return all_logs
+def get_finalized_block_number(web3):
+    # Providers without the finalized tag get a fixed confirmation depth instead
+    try:
+        return web3.eth.get_block("finalized")["number"]
+    except Exception as e:
+        logging.error(f"Error fetching finalized block, assuming {FINALITY_DEPTH} confirmations: {e}")
+        return web3.eth.block_number - FINALITY_DEPTH
+
+
+def split_logs_by_contract(logs, contract_addresses):
+    logs_by_contract = {address: [] for address in contract_addresses}
+    address_lookup = {address.lower(): address for address in contract_addresses}
+    for log in logs:
+        logs_by_contract[address_lookup[log["address"].lower()]].append(log)
+    return logs_by_contract
+
+
+async def fetch_logs_for_segment(segment, transport, contract_addresses, range_sizes, store, retry_policy, retry_ranges=()):
+    segment_start, segment_end = segment
+    all_logs = []
+    worked_sizes = {}
+    failed_ranges = []
+
+    # Ranges are cut from the segment at the current window size and sent a batch at a
+    # time. The window grows while responses stay small and halves when a range hits
+    # the provider's result size limit; that range is bisected and re-sent. Ranges
+    # that run out of retries are returned as dead letters; a later pass hands them
+    # back in retry_ranges with an empty segment.
+    cursor = segment_start
+    size = range_size_for(range_sizes, cursor, BLOCK_RANGE_LIMIT)
+    bucket = cursor // SIZE_BUCKET_BLOCKS
+    pending = [(start_block, end_block, 0) for start_block, end_block in retry_ranges]
+    while pending or cursor <= segment_end:
+        while len(pending) < transport.max_batch_size and cursor <= segment_end:
+            if cursor // SIZE_BUCKET_BLOCKS != bucket:
+                bucket = cursor // SIZE_BUCKET_BLOCKS
+                size = range_size_for(range_sizes, cursor, size)
+            end_block = min(cursor + size - 1, segment_end)
+            pending.append((cursor, end_block, 0))
+            cursor = end_block + 1
+
+        filters = [create_log_filter_params(contract_addresses, start_block, end_block, TRANSFER_EVENT_SIGNATURE) for start_block, end_block, _ in pending]
+        retry_policy.record_requests(len(filters))
+        try:
+            results = await transport.make_batch_request([("eth_getLogs", [filter_params]) for filter_params in filters])
+        except Exception as e:
+            logging.error(f"Error fetching logs: {e}")
+            results = [e] * len(pending)
+
+        failed = []
+        batch_logs = []
+        largest_result = 0
+        hit_size_limit = False
+        for (start_block, end_block, retry_count), result in zip(pending, results):
+            if not isinstance(result, Exception):
+                batch_logs.extend(result)
+                largest_result = max(largest_result, len(result))
+                record_range_size(worked_sizes, start_block, end_block - start_block + 1)
+                METRICS.inc("scan_blocks_total", end_block - start_block + 1)
+            elif is_result_size_error(result) and end_block > start_block:
+                hit_size_limit = True
+                METRICS.inc("scan_range_splits_total")
+                middle = (start_block + end_block) // 2
+                failed.append((start_block, middle, 0))
+                failed.append((middle + 1, end_block, 0))
+            elif retry_policy.can_retry(retry_count + 1):
+                logging.error(f"Error fetching logs for {start_block}-{end_block}: {result}")
+                failed.append((start_block, end_block, retry_count + 1))
+            else:
+                logging.error(f"Giving up on logs for {start_block}-{end_block} after {retry_count + 1} attempts: {result}")
+                failed_ranges.append((start_block, end_block))
+                METRICS.inc("dead_letters_total", stage="scan")
+
+        insert_transfer_logs(store, batch_logs)
+        METRICS.inc("scan_logs_total", len(batch_logs))
+        all_logs.extend(batch_logs)
+        size = next_range_size(size, largest_result, hit_size_limit)
+        retries = [retry_count for _, _, retry_count in failed if retry_count > 0]
+        if retries:
+            METRICS.inc("retries_total", len(retries), stage="scan")
+            await retry_policy.backoff(max(retries), len(retries))
+        pending = failed
+
+    return split_logs_by_contract(all_logs, contract_addresses), worked_sizes, failed_ranges
+
+
+def checkpoint_scan_progress(network_name, segments, tasks, checkpointed, last_block, addresses):
+    # Moves the checkpoint up to the highest block below which every segment has
+    # completed, stopping at the first failed range, and adds the addresses found on
+    # the way. Returns the updated (segments checkpointed, last block).
+    previous_block = last_block
+    while checkpointed < len(tasks) and tasks[checkpointed].done():
+        logs_by_contract, _, failed_ranges = tasks[checkpointed].result()
+        addresses.update(extract_to_addresses(list(itertools.chain.from_iterable(logs_by_contract.values()))))
+        if failed_ranges:
+            # Nothing past a gap can be checkpointed during this scan
+            last_block = min(start_block for start_block, _ in failed_ranges) - 1
+            checkpointed = len(tasks)
+        else:
+            last_block = segments[checkpointed][1]
+            checkpointed += 1
+    if last_block != previous_block:
+        save_scan_checkpoint(network_name, last_block, addresses)
+    return checkpointed, last_block
+
+
+async def scan_logs(segments, rpc_urls, contract_addresses, range_sizes, store_path, controllers, network_name, known_addresses, cache=None):
+    # Every segment runs as its own coroutine; each endpoint's controller caps its requests in flight.
+    # Progress is checkpointed every SCAN_CHECKPOINT_SECONDS, so an interrupted scan resumes close to where it stopped.
+    store = open_event_store(store_path)
+    retry_policy = RetryPolicy()
+    addresses = set(known_addresses)
+    checkpointed = 0
+    last_block = segments[0][0] - 1 if segments else None
+    checkpointed_at = time.monotonic()
+    async with create_endpoint_pool(rpc_urls, controllers, cache) as transport:
+        tasks = [asyncio.ensure_future(fetch_logs_for_segment(segment, transport, contract_addresses, range_sizes, store, retry_policy)) for segment in segments]
+        for task in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="Scanning logs"):
+            await task
+            if time.monotonic() - checkpointed_at >= SCAN_CHECKPOINT_SECONDS:
+                checkpointed, last_block = checkpoint_scan_progress(network_name, segments, tasks, checkpointed, last_block, addresses)
+                checkpointed_at = time.monotonic()
+        results = [task.result() for task in tasks]
+
+        # Dead-lettered ranges get one more batched pass with a fresh retry budget
+        dead_letters = [block_range for _, _, failed_ranges in results for block_range in failed_ranges]
+        if dead_letters:
+            print(f"Retrying {len(dead_letters)} failed block ranges")
+            logs_by_contract, worked_sizes, failed_ranges = await fetch_logs_for_segment((1, 0), transport, contract_addresses, range_sizes, store, RetryPolicy(), retry_ranges=dead_letters)
+            results = [(logs, sizes, []) for logs, sizes, _ in results] + [(logs_by_contract, worked_sizes, failed_ranges)]
+    store.close()
+    return results
 
 
 def divide_into_chunks(start_block, end_block, chunk_size):
     ranges = []
-    while start_block < end_block:
+    while start_block <= end_block:
         batch_end_block = min(start_block + chunk_size, end_block)
         ranges.append((start_block, batch_end_block))
         start_block = batch_end_block + 1
     return ranges
 
 
-def extract_to_addresses(logs):
-    to_addresses = set()
-    for log in logs:
-        encoded_address = log["topics"][2]
-        decoded_address = Web3.to_checksum_address(encoded_address.hex()[-40:])
-        to_addresses.add(decoded_address)
-    return list(to_addresses)
+def checksum_address(address):
+    # EIP-55 checksum of a 20-byte address: hex digits whose keccak nibble is 8 or more are uppercased
+    hex_address = address.hex()
+    hashed = keccak(text=hex_address).hex()
+    return "0x" + "".join(char.upper() if nibble in "89abcdef" else char for char, nibble in zip(hex_address, hashed))
 
 
-def fetch_account_data(account, gmx, staked_gmx_tracker, esgmx, glp, staked_fee_gmx_tracker, bonus_gmx_tracker, gmx_vester, glp_vester, contract_addresses, helper_contracts, multicall, max_retries=10, initial_wait=1):
+def extract_to_addresses(logs):
+    # Recipients repeat across logs, so they are deduplicated as raw 20-byte keys
+    # and only the unique ones are checksummed
+    raw_addresses = {bytes.fromhex(log["topics"][2][-40:]) for log in logs}
+    return [checksum_address(address) for address in raw_addresses]
+
+
+def build_account_call_plan(contract_addresses, helper_contracts):
+    return [
+        CallTemplate(contract_addresses[0], gmx_abi, "balanceOf"),
+        CallTemplate(helper_contracts[0], staked_gmx_tracker_abi, "depositBalances", [contract_addresses[0]]),
+        CallTemplate(helper_contracts[1], gmx_abi, "balanceOf"),
+        CallTemplate(helper_contracts[0], staked_gmx_tracker_abi, "depositBalances", [helper_contracts[1]]),
+        CallTemplate(helper_contracts[3], staked_gmx_tracker_abi, "claimable"),
+        CallTemplate(helper_contracts[2], staked_gmx_tracker_abi, "stakedAmounts"),
+        CallTemplate(contract_addresses[3], gmx_abi, "balanceOf"),
+        CallTemplate(helper_contracts[4], gmx_vester_abi, "getMaxVestableAmount"),
+        CallTemplate(helper_contracts[5], gmx_vester_abi, "getMaxVestableAmount"),
+    ]
+
+
+def build_pair_amount_call_plan(helper_contracts):
+    return [
+        CallTemplate(helper_contracts[4], gmx_vester_abi, "getPairAmount"),
+        CallTemplate(helper_contracts[5], gmx_vester_abi, "getPairAmount"),
+    ]
+
+
+def encode_pair_amount_calls(pair_plan, account, esgmx1, esgmx2):
+    account_word = address_word(account)
+    return [
+        pair_plan[0].encode(account_word, uint_word(esgmx1)),
+        pair_plan[1].encode(account_word, uint_word(esgmx2)),
+    ]
+
+
+def estimate_account_batch_size(web3, multicall_address, sample_calls, gas_cap=ETH_CALL_GAS_CAP, max_response_bytes=MAX_RESPONSE_BYTES):
+    # Size batches from what one account costs: the gas of a single-account aggregate
+    # against the provider's eth_call gas cap, and the hex-encoded (bool,bytes)
+    # entry per call (offset + success + bytes offset + length + one word) against
+    # the response size limit.
+    if not sample_calls:
+        return MAX_ACCOUNT_BATCH_SIZE
     try:
-        calls = [
-            {"target": contract_addresses[0], "callData": gmx.encodeABI(fn_name="balanceOf", args=[account])},
-            {"target": helper_contracts[0], "callData": staked_gmx_tracker.encodeABI(fn_name="depositBalances", args=[account, contract_addresses[0]])},
-            {"target": helper_contracts[1], "callData": esgmx.encodeABI(fn_name="balanceOf", args=[account])},
-            {"target": helper_contracts[0], "callData": staked_gmx_tracker.encodeABI(fn_name="depositBalances", args=[account, helper_contracts[1]])},
-            {"target": helper_contracts[3], "callData": bonus_gmx_tracker.encodeABI(fn_name="claimable", args=[account])},
-            {"target": helper_contracts[2], "callData": staked_fee_gmx_tracker.encodeABI(fn_name="stakedAmounts", args=[account])},
-            {"target": contract_addresses[3], "callData": glp.encodeABI(fn_name="balanceOf", args=[account])},
-            {"target": helper_contracts[4], "callData": gmx_vester.encodeABI(fn_name="getMaxVestableAmount", args=[account])},
-            {"target": helper_contracts[5], "callData": glp_vester.encodeABI(fn_name="getMaxVestableAmount", args=[account])},
-        ]
-
-        # First multicall with retry mechanism
-        result = None
-        retry_count = 0
-        while retry_count < max_retries:
-            try:
-                result = multicall.functions.aggregate(calls).call()
-                break
-            except Exception as e:
-                logging.error(f"Error in first multicall for account {account}: {e}")
-                retry_count += 1
-                time.sleep(initial_wait * 2**retry_count)
-
-        if retry_count == max_retries:
-            logging.error(f"Failed to aggregate calls after {max_retries} attempts for account {account}")
-            return None
-
-        # Decoding results from the first multicall
-        gmx_wallet = int(result[1][0].hex(), 16) / 10**18
-        gmx_staked = int(result[1][1].hex(), 16) / 10**18
-        esgmx_wallet = int(result[1][2].hex(), 16) / 10**18
-        esgmx_staked = int(result[1][3].hex(), 16) / 10**18
-        mp_wallet = int(result[1][4].hex(), 16) / 10**18
-        mp_staked = int(result[1][5].hex(), 16) / 10**18
-        glp_wallet = int(result[1][6].hex(), 16) / 10**18
-        esgmx1 = int(result[1][7].hex(), 16)
-        esgmx2 = int(result[1][8].hex(), 16)
-
-        # Setup for the second set of multicall
-        calls1 = [
-            {"target": helper_contracts[4], "callData": gmx_vester.encodeABI(fn_name="getPairAmount", args=[account, esgmx1])},
-            {"target": helper_contracts[5], "callData": glp_vester.encodeABI(fn_name="getPairAmount", args=[account, esgmx2])},
-        ]
-
-        # Second multicall with retry mechanism
-        result1 = None
-        retry_count = 0
-        while retry_count < max_retries:
-            try:
-                result1 = multicall.functions.aggregate(calls1).call()
-                break
-            except Exception as e:
-                logging.error(f"Error in second multicall for account {account}: {e}")
-                retry_count += 1
-                time.sleep(initial_wait * 2**retry_count)
-
-        if retry_count == max_retries:
-            logging.error(f"Failed to aggregate calls1 after {max_retries} attempts for account {account}")
-            return None
-
-        # Decoding results from the second multicall
-        gmx_to_vest = int(result1[1][0].hex(), 16) / 10**18
-        glp_to_vest = int(result1[1][1].hex(), 16) / 10**18
-
-        # Constructing the data dictionary
-        data = {
-            "account": account,
-            "GMX in wallet": gmx_wallet,
-            "GMX staked": gmx_staked,
-            "esGMX in wallet": esgmx_wallet,
-            "esGMX staked": esgmx_staked,
-            "MP in wallet": mp_wallet,
-            "MP staked": mp_staked - (gmx_staked + esgmx_staked),
-            "GLP in wallet": glp_wallet,
-            "GLP staked": glp_wallet,
-            "esGMX earned from GMX/esGMX/MPs": esgmx1 / 10**18,
-            "GMX needed to vest": gmx_to_vest,
-            "esGMX earned from GLP": esgmx2 / 10**18,
-            "GLP needed to vest": glp_to_vest,
-        }
-        return data
-
+        gas_per_account = web3.eth.estimate_gas({"to": multicall_address, "data": "0x" + encode_try_aggregate_calldata(sample_calls).hex()})
     except Exception as e:
-        logging.error(f"Error fetching data for account {account}: {e}")
-        return None
+        logging.error(f"Error estimating multicall gas, using default: {e}")
+        gas_per_account = DEFAULT_GAS_PER_CALL * len(sample_calls)
 
+    by_gas = int(gas_cap * BATCH_GAS_HEADROOM) // max(gas_per_account, 1)
+    by_response = max_response_bytes // (len(sample_calls) * 160 * 2)
+    return max(1, min(by_gas, by_response, MAX_ACCOUNT_BATCH_SIZE))
 
-if __name__ == "__main__":
-    network_name, rpc_url, contract_addresses, helper_contracts, deployment_block = choose_network()
-    latest_block_number = initialize_web3_connection(rpc_url).eth.block_number
 
-    block_ranges = divide_into_chunks(deployment_block, latest_block_number, BLOCK_RANGE_LIMIT)
-    args = [(range_info, rpc_url, contract_addresses) for range_info in block_ranges]
-    chunksize = 20
+def encode_try_aggregate_calldata(calls):
+    return TRY_AGGREGATE_SELECTOR + abi.encode(["bool", "(address,bytes)[]"], [False, calls])
+
 
-    all_logs = process_map(fetch_logs_for_range, args, chunksize=chunksize, max_workers=NUM_PROCESSES)
-    all_logs_flat = list(itertools.chain(*all_logs))
-    unique_to_addresses = extract_to_addresses(all_logs_flat)
+def encode_try_aggregate(multicall_address, calls, block_identifier="latest"):
+    return ("eth_call", [{"to": multicall_address, "data": "0x" + encode_try_aggregate_calldata(calls).hex()}, block_identifier])
 
-    web3 = initialize_web3_connection(rpc_url)
 
-    gmx = web3.eth.contract(address=contract_addresses[0], abi=gmx_abi)
-    staked_gmx_tracker = web3.eth.contract(address=helper_contracts[0], abi=staked_gmx_tracker_abi)
-    esgmx = web3.eth.contract(address=helper_contracts[1], abi=gmx_abi)
-    glp = web3.eth.contract(address=contract_addresses[3], abi=gmx_abi)
-    staked_fee_gmx_tracker = web3.eth.contract(address=helper_contracts[2], abi=staked_gmx_tracker_abi)
-    bonus_gmx_tracker = web3.eth.contract(address=helper_contracts[3], abi=staked_gmx_tracker_abi)
-    gmx_vester = web3.eth.contract(address=helper_contracts[4], abi=gmx_vester_abi)
-    glp_vester = web3.eth.contract(address=helper_contracts[5], abi=gmx_vester_abi)
-    multicall = web3.eth.contract(address=helper_contracts[6], abi=multicall_abi)
+def decode_try_aggregate(result):
+    return decode_try_aggregate_return(bytes.fromhex(result[2:]))
 
-    print(f"Found {len(unique_to_addresses)} Unique addresses")
 
-    df = pd.DataFrame(columns=["account", "GMX in wallet", "GMX staked", "esGMX in wallet", "esGMX staked", "GLP in wallet", "GLP staked", "MP in wallet", "MP staked", "esGMX earned from GMX/esGMX/MPs", "GMX needed to vest", "esGMX earned from GLP", "GLP needed to vest"])
+def is_aggregate_size_error(error):
+    message = str(error).lower()
+    return isinstance(error, RPCError) and any(pattern in message for pattern in AGGREGATE_SIZE_ERRORS)
 
-    df["account"] = unique_to_addresses
 
-    df.to_csv(f"gmx_accounts_{network_name}.csv", index=False)
+async def execute_calls(multicall_address, transport, calls, description, retry_policy, block_identifier="latest"):
+    # Reverting calls only flag their own result with requireSuccess=false, so an
+    # aggregate the node rejects as too big (gas or response size) would fail the
+    # same way again: it is split in half at once, and the halves go out in the next
+    # round without a delay or a charge to the retry budget. Every other failure,
+    # including one on a single call, is retried at the same size after a backoff;
+    # sub-batches that are due share one JSON-RPC batch.
+    # Returns the return data per call, or None if it failed.
+    return_data = [None] * len(calls)
+    pending = [(0, calls, 0)]
+    waiting = []
+    while pending or waiting:
+        if not pending:
+            await retry_policy.sleep(max(0.0, min(due for due, _ in waiting) - time.monotonic()))
+        now = time.monotonic()
+        pending += [item for due, item in waiting if due <= now]
+        waiting = [(due, item) for due, item in waiting if due > now]
 
-    with ThreadPoolExecutor(max_workers=NUM_PROCESSES) as executor:
-        # Submitting tasks to the executor
-        future_to_account = {executor.submit(fetch_account_data, account, gmx, staked_gmx_tracker, esgmx, glp, staked_fee_gmx_tracker, bonus_gmx_tracker, gmx_vester, glp_vester, contract_addresses, helper_contracts, multicall): account for account in unique_to_addresses}
+        retry_policy.record_requests(len(pending))
+        try:
+            results = await transport.make_batch_request([encode_try_aggregate(multicall_address, sub_calls, block_identifier) for _, sub_calls, _ in pending])
+        except Exception as e:
+            logging.error(f"Error in multicall for {description}: {e}")
+            results = [e] * len(pending)
 
-        # Using tqdm to display progress
-        for future in tqdm(as_completed(future_to_account), total=len(unique_to_addresses), desc="Fetching accounts data"):
-            account = future_to_account[future]
+        splits = []
+        retries = []
+        for (offset, sub_calls, retry_count), result in zip(pending, results):
             try:
-                account_data = future.result()
-                if account_data:
-                    # Find the index for the current account and update the DataFrame
-                    index = df[df["account"] == account].index[0]
-                    for key, value in account_data.items():
-                        df.at[index, key] = value
+                if isinstance(result, Exception):
+                    raise result
+                for i, data in enumerate(decode_try_aggregate(result)):
+                    return_data[offset + i] = data
+                continue
             except Exception as e:
-                print(f"Error processing data for account {account}: {str(e)}")
+                logging.error(f"Error in multicall for {description}: {e}")
+                error = e
+
+            if is_aggregate_size_error(error) and len(sub_calls) > 1:
+                METRICS.inc("multicall_splits_total")
+                middle = len(sub_calls) // 2
+                splits.append((offset, sub_calls[:middle], 0))
+                splits.append((offset + middle, sub_calls[middle:], 0))
+            elif retry_policy.can_retry(retry_count + 1):
+                retries.append((offset, sub_calls, retry_count + 1))
+            else:
+                logging.error(f"Giving up on {len(sub_calls)} calls after {retry_count + 1} attempts for {description}")
+
+        if retries:
+            METRICS.inc("retries_total", len(retries), stage="accounts")
+            due = time.monotonic() + retry_policy.schedule(max(retry_count for _, _, retry_count in retries), len(retries))
+            waiting += [(due, item) for item in retries]
+        pending = splits
+
+    return return_data
+
+
+def build_account_columns(accounts, values, pair_values):
+    # Columns stay in raw token units; scale_account_columns converts them on export
+    return {
+        "account": accounts,
+        "GMX in wallet": values[:, 0],
+        "GMX staked": values[:, 1],
+        "esGMX in wallet": values[:, 2],
+        "esGMX staked": values[:, 3],
+        "MP in wallet": values[:, 4],
+        "MP staked": values[:, 5],
+        "GLP in wallet": values[:, 6],
+        "GLP staked": values[:, 6],
+        "esGMX earned from GMX/esGMX/MPs": values[:, 7],
+        "GMX needed to vest": pair_values[:, 0],
+        "esGMX earned from GLP": values[:, 8],
+        "GLP needed to vest": pair_values[:, 1],
+    }
 
-    df.to_csv(f"gmx_accounts_{network_name}_{latest_block_number}.csv", index=False)
-    print(f"CSV file created: gmx_accounts_{network_name}_{latest_block_number}.csv")
+
+def scale_account_columns(df):
+    value_columns = [column for column in ACCOUNT_COLUMNS if column != "account"]
+    df[value_columns] = df[value_columns].astype(float) / 10**18
+    df["MP staked"] = df["MP staked"] - (df["GMX staked"] + df["esGMX staked"])
+    return df
+
+
+async def fetch_accounts_data(accounts, account_plan, pair_plan, multicall_address, transport, retry_policy, block_identifier="latest"):
+    # Returns (columns, failed_accounts): raw-unit columns for the accounts whose calls
+    # all succeeded, or None, and the accounts whose calls did not
+    description = f"batch of {len(accounts)} accounts starting at {accounts[0]}"
+    try:
+        calls = encode_calls(account_plan, accounts)
+
+        # All state reads for the batch go out in one aggregate
+        return_data = await execute_calls(multicall_address, transport, calls, description, retry_policy, block_identifier)
+        values, ok = decode_uint256_rows(return_data, CALLS_PER_ACCOUNT)
+        failed_accounts = list(itertools.compress(accounts, ~ok))
+        for account in failed_accounts:
+            logging.error(f"Failed to fetch state for account {account}")
+        fetched_accounts = list(itertools.compress(accounts, ok))
+        values = values[ok]
+        if not fetched_accounts:
+            return None, failed_accounts
+
+        # The vested pair amounts depend on the first results, so they go in a second
+        # aggregate. Their arguments need the exact esGMX amounts, not the float columns.
+        return_data = list(itertools.compress(return_data, np.repeat(ok, CALLS_PER_ACCOUNT)))
+        pair_calls = []
+        for i, account in enumerate(fetched_accounts):
+            esgmx1 = int.from_bytes(return_data[i * CALLS_PER_ACCOUNT + 7][:32], "big")
+            esgmx2 = int.from_bytes(return_data[i * CALLS_PER_ACCOUNT + 8][:32], "big")
+            pair_calls.extend(encode_pair_amount_calls(pair_plan, account, esgmx1, esgmx2))
+
+        pair_return_data = await execute_calls(multicall_address, transport, pair_calls, description, retry_policy, block_identifier)
+        pair_values, pair_ok = decode_uint256_rows(pair_return_data, PAIR_CALLS_PER_ACCOUNT)
+        for account in itertools.compress(fetched_accounts, ~pair_ok):
+            logging.error(f"Failed to fetch pair amounts for account {account}")
+            failed_accounts.append(account)
+        if not pair_ok.any():
+            return None, failed_accounts
+
+        return build_account_columns(list(itertools.compress(fetched_accounts, pair_ok)), values[pair_ok], pair_values[pair_ok]), failed_accounts
+
+    except Exception as e:
+        # The whole batch is dead-lettered, including accounts that failed before the error
+        logging.error(f"Error fetching data for {description}: {e}")
+        return None, accounts
+
+
+async def fetch_all_accounts(accounts, batch_size, account_plan, pair_plan, multicall_address, rpc_urls, controllers, block_number, on_batch_done, cache=None):
+    # Every read is pinned to block_number, so the output is one consistent snapshot
+    # however long the run takes. on_batch_done(batch, columns) is called on the
+    # event loop as each batch finishes.
+    # Accounts that fail go to a dead-letter list and get one more pass at the end,
+    # in batches of the same size, with a fresh retry budget.
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_ACCOUNT_BATCHES)
+    block_identifier = hex(block_number)
+
+    async with create_endpoint_pool(rpc_urls, controllers, cache) as transport:
+
+        async def fetch_batch(batch, retry_policy):
+            async with semaphore:
+                return batch, await fetch_accounts_data(batch, account_plan, pair_plan, multicall_address, transport, retry_policy, block_identifier)
+
+        async def run_pass(accounts, retry_policy, desc):
+            batches = [accounts[i : i + batch_size] for i in range(0, len(accounts), batch_size)]
+            dead_letters = []
+            with tqdm(total=sum(len(batch) for batch in batches), desc=desc) as progress:
+                for task in asyncio.as_completed([fetch_batch(batch, retry_policy) for batch in batches]):
+                    batch, (columns, failed_accounts) = await task
+                    on_batch_done(batch, columns)
+                    dead_letters.extend(failed_accounts)
+                    METRICS.inc("accounts_fetched_total", len(batch) - len(failed_accounts))
+                    progress.update(len(batch))
+            return dead_letters
+
+        dead_letters = await run_pass(accounts, RetryPolicy(), "Fetching accounts data")
+        if dead_letters:
+            dead_letters = await run_pass(dead_letters, RetryPolicy(), "Retrying failed accounts")
+        for account in dead_letters:
+            logging.error(f"Giving up on account {account}")
+        METRICS.inc("dead_letters_total", len(dead_letters), stage="accounts")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    network_name, rpc_urls, contract_addresses, helper_contracts, deployment_block = choose_network()
+    if args.record or args.replay:
+        rpc_urls = start_rpc_stand_ins(rpc_urls, args)
+    if args.metrics_port is not None:
+        serve_prometheus(METRICS, args.metrics_port)
+    if args.metrics_file:
+        atexit.register(start_metrics_file(METRICS, args.metrics_file))
+    if args.trace:
+        TRACER.enable()
+        atexit.register(TRACER.save, args.trace)
+    profiler = StageProfiler(args.profile)
+    atexit.register(profiler.print_summary)
+
+    with profiler.stage("plan"):
+        web3 = initialize_web3_connection(rpc_urls[0])
+
+        # An unfinished snapshot is picked up at its block, so its journal of completed accounts stays valid
+        partial_output = find_partial_output(network_name)
+        if partial_output is None:
+            latest_block_number = web3.eth.block_number
+        else:
+            latest_block_number = partial_output[0]
+            print(f"Resuming unfinished snapshot at block {latest_block_number}")
+
+        checkpoint = load_scan_checkpoint(network_name)
+        if checkpoint is None:
+            scan_start_block, known_addresses = deployment_block, set()
+        else:
+            last_scanned_block, known_addresses = checkpoint
+            scan_start_block = last_scanned_block + 1
+            print(f"Resuming scan from block {scan_start_block} with {len(known_addresses)} known addresses")
+
+        range_sizes = load_range_sizes(network_name)
+        store_path = event_store_path(network_name)
+        segment_size = max(BLOCK_RANGE_LIMIT, (latest_block_number - scan_start_block) // SCAN_SEGMENTS)
+        segments = divide_into_chunks(scan_start_block, latest_block_number, segment_size)
+
+        # One controller per endpoint for both stages, so the account fetch starts at the concurrency the scan settled on
+        controllers = {rpc_url: ConcurrencyController(MAX_IN_FLIGHT_REQUESTS) for rpc_url in rpc_urls}
+        # Requests that only read finalized blocks are answered from the response cache on
+        # reruns; record and replay runs bypass it so every request reaches the stand-ins
+        cache = None if args.record or args.replay else ResponseCache(response_cache_path(network_name), get_finalized_block_number(web3))
+
+    with profiler.stage("scan"):
+        results = asyncio.run(scan_logs(segments, rpc_urls, contract_addresses, range_sizes, store_path, controllers, network_name, known_addresses, cache))
+        scanned_sizes = {}
+        failed_ranges = []
+        for _, worked_sizes, segment_failed_ranges in results:
+            merge_range_sizes(scanned_sizes, worked_sizes)
+            failed_ranges.extend(segment_failed_ranges)
+        range_sizes.update(scanned_sizes)
+        save_range_sizes(network_name, range_sizes)
+
+    with profiler.stage("extract"):
+        all_logs_flat = list(itertools.chain.from_iterable(logs for logs_by_contract, _, _ in results for logs in logs_by_contract.values()))
+        unique_to_addresses = sorted(known_addresses.union(extract_to_addresses(all_logs_flat)))
+
+        # Only blocks before the first failed range count as scanned, so the next run picks the gaps up again
+        if failed_ranges:
+            last_scanned_block = min(start_block for start_block, _ in failed_ranges) - 1
+            logging.error(f"{len(failed_ranges)} block ranges failed, checkpointing at block {last_scanned_block}")
+        else:
+            last_scanned_block = max(latest_block_number, scan_start_block - 1)
+        save_scan_checkpoint(network_name, last_scanned_block, unique_to_addresses)
+
+    with profiler.stage("setup"):
+        account_plan = build_account_call_plan(contract_addresses, helper_contracts)
+        pair_plan = build_pair_amount_call_plan(helper_contracts)
+        multicall_address = helper_contracts[6]
+
+        print(f"Found {len(unique_to_addresses)} Unique addresses")
+
+        pd.DataFrame({"account": unique_to_addresses}, columns=ACCOUNT_COLUMNS).to_csv(f"gmx_accounts_{network_name}.csv", index=False)
+
+        output_path = f"gmx_accounts_{network_name}_{latest_block_number}.csv"
+        sink = StreamingCSVSink(output_path, ACCOUNT_COLUMNS, transform=scale_account_columns)
+        pending_accounts = [account for account in unique_to_addresses if account not in sink.written]
+        if sink.written:
+            print(f"{len(sink.written)} accounts already fetched for block {latest_block_number}, {len(pending_accounts)} left")
+
+        sample_calls = encode_calls(account_plan, unique_to_addresses[:1])
+        batch_size = estimate_account_batch_size(web3, multicall_address, sample_calls)
+        print(f"Fetching {len(pending_accounts)} accounts in {-(-len(pending_accounts) // batch_size)} batches of up to {batch_size}")
+
+    def collect_batch(batch, columns):
+        if columns is not None:
+            sink.add_batch(columns)
+
+    with profiler.stage("fetch"):
+        try:
+            asyncio.run(fetch_all_accounts(pending_accounts, batch_size, account_plan, pair_plan, multicall_address, rpc_urls, controllers, latest_block_number, collect_batch, cache))
+        except KeyboardInterrupt:
+            # asyncio.run cancels the fetch at an await, so no batch is half-collected here
+            sink.flush()
+            print(f"Interrupted, {len(sink.written)} completed accounts saved to {sink.partial_path}")
+            raise SystemExit(130)
+
+        sink.close(unique_to_addresses)
+
+    if cache is not None:
+        cache.close()
+        print(f"Response cache: {cache.hits} hits, {cache.misses} misses")
+    print(f"CSV file created: {output_path}")
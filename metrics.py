@@ -0,0 +1,155 @@
+import bisect
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PREFIX = "gmx"
+METRICS_INTERVAL = 15
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SUMMARY_QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    # Counters and histograms keyed by name and label set. The pipeline updates
+    # them from its event loop; exporters read them from other threads, so both
+    # sides take the lock.
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets)
+            self.histograms[key].observe(value)
+
+    def to_prometheus(self):
+        lines = []
+        with self._lock:
+            uptime = time.time() - self.started
+            lines.append(f"# TYPE {METRICS_PREFIX}_uptime_seconds gauge")
+            lines.append(f"{METRICS_PREFIX}_uptime_seconds {uptime:.3f}")
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {METRICS_PREFIX}_{name} counter")
+                    typed.add(name)
+                lines.append(f"{METRICS_PREFIX}_{name}{format_labels(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {METRICS_PREFIX}_{name} histogram")
+                    typed.add(name)
+                cumulative = 0
+                for bound, count in zip((*histogram.buckets, "+Inf"), histogram.counts):
+                    cumulative += count
+                    lines.append(f"{METRICS_PREFIX}_{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{METRICS_PREFIX}_{name}_sum{format_labels(labels)} {histogram.sum:.6f}")
+                lines.append(f"{METRICS_PREFIX}_{name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def to_json(self):
+        # Counters come with their average rate over the run; histograms are
+        # summarised as count, mean and bucketed quantiles
+        with self._lock:
+            uptime = time.time() - self.started
+            counters = [{"name": name, "labels": dict(labels), "value": value, "per_second": value / max(uptime, 1e-9)} for (name, labels), value in sorted(self.counters.items())]
+            histograms = [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": histogram.count,
+                    "mean": histogram.sum / histogram.count if histogram.count else None,
+                    **{f"p{round(q * 100)}": histogram.quantile(q) for q in SUMMARY_QUANTILES},
+                }
+                for (name, labels), histogram in sorted(self.histograms.items())
+            ]
+        return {"uptime_seconds": uptime, "counters": counters, "histograms": histograms}
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+def serve_prometheus(metrics, port):
+    # Serves the text exposition format at /metrics from a daemon thread. Returns the server.
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.to_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def write_metrics_file(metrics, path):
+    with open(path + ".tmp", "w") as f:
+        json.dump(metrics.to_json(), f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def start_metrics_file(metrics, path, interval=METRICS_INTERVAL):
+    # Rewrites path every interval seconds from a daemon thread. Returns a stop
+    # function that writes the final numbers.
+    stopped = threading.Event()
+
+    def run():
+        while not stopped.wait(interval):
+            write_metrics_file(metrics, path)
+
+    threading.Thread(target=run, daemon=True).start()
+
+    def stop():
+        stopped.set()
+        write_metrics_file(metrics, path)
+
+    return stop
+
+
+METRICS = Metrics()
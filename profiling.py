@@ -0,0 +1,80 @@
+import contextlib
+import cProfile
+import io
+import json
+import os
+import pstats
+import time
+import tracemalloc
+from tracing import STAGE_LANE, TRACER
+
+REPORT_FUNCTIONS = 40
+
+
+class StageProfiler:
+    # Opt-in per-stage profiling. Each stage runs under cProfile, with wall time,
+    # CPU time and traced allocations (net and peak) measured around it. The
+    # asyncio stages run in this thread, so their coroutines are profiled too.
+    # Reports go to output_dir as <n>_<stage>.prof (for pstats or snakeviz),
+    # <n>_<stage>.txt (top functions by cumulative time) and summary.json.
+    # Without an output_dir stages are only marked on the trace timeline.
+
+    def __init__(self, output_dir=None):
+        self.output_dir = output_dir
+        self.stages = []
+        if output_dir is not None:
+            os.makedirs(output_dir, exist_ok=True)
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        # Stage boundaries also go to the trace timeline, profiled or not
+        with TRACER.span(name, "stage", lane=STAGE_LANE):
+            if self.output_dir is None:
+                yield
+            else:
+                with self._profile(name):
+                    yield
+
+    @contextlib.contextmanager
+    def _profile(self, name):
+        profile = cProfile.Profile()
+        tracemalloc.reset_peak()
+        allocated_before = tracemalloc.get_traced_memory()[0]
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            allocated, peak = tracemalloc.get_traced_memory()
+            self.stages.append({
+                "stage": name,
+                "wall_seconds": time.perf_counter() - wall_start,
+                "cpu_seconds": time.process_time() - cpu_start,
+                "allocated_bytes": allocated - allocated_before,
+                "peak_bytes": peak,
+            })
+            self.write_stage_report(len(self.stages), name, profile)
+            self.write_summary()
+
+    def write_stage_report(self, index, name, profile):
+        path = os.path.join(self.output_dir, f"{index}_{name}")
+        profile.dump_stats(path + ".prof")
+        report = io.StringIO()
+        pstats.Stats(profile, stream=report).sort_stats("cumulative").print_stats(REPORT_FUNCTIONS)
+        with open(path + ".txt", "w") as f:
+            f.write(report.getvalue())
+
+    def write_summary(self):
+        with open(os.path.join(self.output_dir, "summary.json"), "w") as f:
+            json.dump(self.stages, f, indent=2)
+
+    def print_summary(self):
+        if not self.stages:
+            return
+        print(f"{'stage':<10} {'wall':>9} {'cpu':>9} {'allocated':>12} {'peak':>12}")
+        for stage in self.stages:
+            print(f"{stage['stage']:<10} {stage['wall_seconds']:8.2f}s {stage['cpu_seconds']:8.2f}s {stage['allocated_bytes'] / 2**20:9.1f} MiB {stage['peak_bytes'] / 2**20:9.1f} MiB")
+        print(f"Profiles written to {self.output_dir}")
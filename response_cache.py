@@ -0,0 +1,178 @@
+import hashlib
+import json
+import sqlite3
+import time
+import zlib
+from collections import OrderedDict
+from metrics import METRICS
+
+MEMORY_CACHE_BYTES = 256 * 1024 * 1024
+DISK_CACHE_BYTES = 4 * 1024 * 1024 * 1024
+DISK_EVICTION_TARGET = 0.9
+SQL_VARIABLE_LIMIT = 500
+# Decoded JSON takes about 2.2x its text length for getLogs results (dicts of hex
+# strings) and about 1x for eth_call hex strings; the memory tier charges the larger
+DECODED_SIZE_FACTOR = 2.5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key BLOB PRIMARY KEY,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_used ON responses (used);
+"""
+
+
+def response_cache_path(network_name):
+    return f"rpc_cache_{network_name}.sqlite"
+
+
+def request_key(method, params):
+    return hashlib.sha256(json.dumps([method, params], sort_keys=True, separators=(",", ":")).encode()).digest()
+
+
+def request_block(method, params):
+    # The highest block a request reads, or None if it is not pinned to a block number
+    try:
+        if method == "eth_getLogs":
+            return int(params[0]["toBlock"], 16)
+        if method == "eth_call":
+            return int(params[1], 16)
+    except (IndexError, KeyError, TypeError, ValueError):
+        pass
+    return None
+
+
+class ResponseCache:
+    # Results of requests that only read finalized blocks never change, so they are
+    # kept by request: an LRU of decoded results in memory in front of an SQLite
+    # store of compressed JSON. Each tier evicts least recently used entries once
+    # it is over its byte limit: the disk tier counts compressed bytes, the memory
+    # tier the estimated size of the decoded results.
+
+    def __init__(self, path, finalized_block, memory_bytes=MEMORY_CACHE_BYTES, disk_bytes=DISK_CACHE_BYTES):
+        self.finalized_block = finalized_block
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.disk_size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+    def is_cacheable(self, method, params):
+        block = request_block(method, params)
+        return block is not None and block <= self.finalized_block
+
+    def get_many(self, keys):
+        # Returns {key: result} for the keys found in either tier
+        found = {}
+        missing = []
+        for key in keys:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                found[key] = self.memory[key][0]
+            else:
+                missing.append(key)
+
+        if missing:
+            now = time.time()
+            with self.conn:
+                for i in range(0, len(missing), SQL_VARIABLE_LIMIT):
+                    chunk = missing[i : i + SQL_VARIABLE_LIMIT]
+                    for key, value in self.conn.execute(f"SELECT key, value FROM responses WHERE key IN ({','.join('?' * len(chunk))})", chunk):
+                        text = zlib.decompress(value)
+                        found[key] = json.loads(text)
+                        self._remember(key, found[key], len(text))
+                self.conn.executemany("UPDATE responses SET used = ? WHERE key = ?", ((now, key) for key in missing if key in found))
+
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        METRICS.inc("rpc_cache_hits_total", len(found))
+        METRICS.inc("rpc_cache_misses_total", len(keys) - len(found))
+        return found
+
+    def put_many(self, items):
+        rows = {}
+        now = time.time()
+        for key, result in items:
+            text = json.dumps(result, separators=(",", ":")).encode()
+            value = zlib.compress(text)
+            rows[key] = (key, value, len(value), now)
+            self._remember(key, result, len(text))
+        if not rows:
+            return
+        keys = list(rows)
+        with self.conn:
+            # Rows being replaced no longer count towards the disk size
+            for i in range(0, len(keys), SQL_VARIABLE_LIMIT):
+                chunk = keys[i : i + SQL_VARIABLE_LIMIT]
+                self.disk_size -= self.conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM responses WHERE key IN ({','.join('?' * len(chunk))})", chunk).fetchone()[0]
+            self.conn.executemany("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", rows.values())
+        self.disk_size += sum(row[2] for row in rows.values())
+        if self.disk_size > self.disk_bytes:
+            self._evict_disk()
+
+    def _remember(self, key, result, text_size):
+        size = int(text_size * DECODED_SIZE_FACTOR)
+        if key in self.memory:
+            self.memory_size -= self.memory.pop(key)[1]
+        self.memory[key] = (result, size)
+        self.memory_size += size
+        while self.memory_size > self.memory_bytes and self.memory:
+            self.memory_size -= self.memory.popitem(last=False)[1][1]
+
+    def _evict_disk(self):
+        target = self.disk_bytes * DISK_EVICTION_TARGET
+        with self.conn:
+            for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY used").fetchall():
+                if self.disk_size <= target:
+                    break
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.disk_size -= size
+
+
+class CachedTransport:
+    # Wraps a transport so finalized requests are answered from the cache where
+    # possible. Only the misses go out, in one batch request; successful results
+    # for finalized requests are stored, errors never are.
+
+    def __init__(self, transport, cache):
+        self.transport = transport
+        self.cache = cache
+        self.max_batch_size = transport.max_batch_size
+
+    async def __aenter__(self):
+        await self.transport.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.transport.__aexit__(*exc_info)
+
+    async def make_request(self, method, params):
+        result = (await self.make_batch_request([(method, params)]))[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    async def make_batch_request(self, calls):
+        keys = [request_key(method, params) if self.cache.is_cacheable(method, params) else None for method, params in calls]
+        found = self.cache.get_many([key for key in keys if key is not None])
+        misses = [i for i, key in enumerate(keys) if key not in found]
+
+        results = [found.get(key) for key in keys]
+        if misses:
+            fetched = await self.transport.make_batch_request([calls[i] for i in misses])
+            for i, result in zip(misses, fetched):
+                results[i] = result
+            self.cache.put_many((keys[i], result) for i, result in zip(misses, fetched) if keys[i] is not None and not isinstance(result, Exception))
+        return results
@@ -0,0 +1,47 @@
+import asyncio
+import random
+from tracing import TRACER
+
+MAX_ATTEMPTS = 3
+BASE_DELAY = 0.25
+MAX_DELAY = 8
+RETRY_BUDGET_RATIO = 0.1
+MIN_RETRY_BUDGET = 50
+
+
+class RetryPolicy:
+    # Capped exponential backoff with full jitter, plus a budget that keeps retries
+    # to RETRY_BUDGET_RATIO of the requests sent so far. Work that runs out of
+    # attempts or budget goes to a dead-letter queue for one final batched pass
+    # rather than holding up the run.
+
+    def __init__(self, max_attempts=MAX_ATTEMPTS, base_delay=BASE_DELAY, max_delay=MAX_DELAY, budget_ratio=RETRY_BUDGET_RATIO, min_budget=MIN_RETRY_BUDGET):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget_ratio = budget_ratio
+        self.min_budget = min_budget
+        self.requests = 0
+        self.retries = 0
+
+    def record_requests(self, count=1):
+        self.requests += count
+
+    def can_retry(self, attempt):
+        # attempt counts the tries already made
+        return attempt < self.max_attempts and self.retries < max(self.min_budget, self.budget_ratio * self.requests)
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def schedule(self, attempt, count=1):
+        # Charges count retries to the budget and returns how long they should wait
+        self.retries += count
+        return self.delay(attempt)
+
+    async def sleep(self, delay):
+        with TRACER.span("retry backoff", "retry", delay=delay):
+            await asyncio.sleep(delay)
+
+    async def backoff(self, attempt, count=1):
+        await self.sleep(self.schedule(attempt, count))
@@ -0,0 +1,197 @@
+import asyncio
+import itertools
+import time
+from urllib.parse import urlparse
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from concurrency import ConcurrencyController
+from metrics import METRICS
+from tracing import TRACER
+
+DEFAULT_BATCH_LIMIT = 20
+MAX_IN_FLIGHT_REQUESTS = 256
+REQUEST_TIMEOUT = 120
+KEEPALIVE_TIMEOUT = 60
+THROTTLE_STATUSES = {429, 502, 503, 504}
+THROTTLE_ERRORS = [
+    "rate limit",
+    "too many requests",
+    "compute units per second",
+    "request limit",
+]
+
+
+class RPCError(Exception):
+    def __init__(self, error):
+        self.code = error.get("code")
+        self.message = error.get("message", "")
+        super().__init__(f"RPC error {self.code}: {self.message}")
+
+
+def is_throttle_error(error):
+    if isinstance(error, RPCError) and error.code == 429:
+        return True
+    message = str(error).lower()
+    return any(pattern in message for pattern in THROTTLE_ERRORS)
+
+
+def parse_retry_after(response):
+    try:
+        return float(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return None
+
+
+def build_batch_payload(ids, calls):
+    return [{"jsonrpc": "2.0", "id": request_id, "method": method, "params": params} for request_id, (method, params) in zip(ids, calls)]
+
+
+def demultiplex_batch_response(ids, body):
+    # A provider that rejects the batch as a whole answers with a single error object
+    if isinstance(body, dict):
+        raise RPCError(body.get("error", {"message": str(body)}))
+
+    by_id = {item.get("id"): item for item in body}
+    results = []
+    for request_id in ids:
+        item = by_id.get(request_id)
+        if item is None:
+            results.append(RPCError({"message": f"missing response for request {request_id}"}))
+        elif "error" in item:
+            results.append(RPCError(item["error"]))
+        else:
+            results.append(item["result"])
+    return results
+
+
+def create_http_session(pool_size=1):
+    # Keep-alive session whose pool holds one connection per thread that shares it,
+    # so TCP and TLS setup happen once per worker instead of once per request
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def create_connector(max_in_flight):
+    return aiohttp.TCPConnector(limit=max_in_flight, limit_per_host=max_in_flight, keepalive_timeout=KEEPALIVE_TIMEOUT, ttl_dns_cache=300)
+
+
+class BatchTransport:
+    # Sends JSON-RPC requests as batch arrays, at most max_batch_size payloads per POST,
+    # and hands each caller back the result for its own request id.
+
+    def __init__(self, rpc_url, max_batch_size=DEFAULT_BATCH_LIMIT, timeout=REQUEST_TIMEOUT, pool_size=1):
+        self.rpc_url = rpc_url
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout
+        self.session = create_http_session(pool_size)
+        self._ids = itertools.count(1)
+
+    def make_request(self, method, params):
+        result = self.make_batch_request([(method, params)])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def make_batch_request(self, calls):
+        # Returns one entry per (method, params) pair, in order: the result, or the
+        # RPCError for that request. Transport failures raise for the whole POST.
+        results = []
+        for i in range(0, len(calls), self.max_batch_size):
+            results.extend(self.post_batch(calls[i : i + self.max_batch_size]))
+        return results
+
+    def post_batch(self, calls):
+        ids = [next(self._ids) for _ in calls]
+        response = self.session.post(self.rpc_url, json=build_batch_payload(ids, calls), timeout=self.timeout)
+        response.raise_for_status()
+        return demultiplex_batch_response(ids, response.json())
+
+
+class AsyncBatchTransport:
+    # asyncio counterpart of BatchTransport. Any number of coroutines can share it;
+    # the controller decides how many POSTs are outstanding at once, up to
+    # max_in_flight, over a keep-alive pool of that size that lives as long as the
+    # transport. Throttling responses and timeouts are reported back to it.
+
+    def __init__(self, rpc_url, max_batch_size=DEFAULT_BATCH_LIMIT, max_in_flight=MAX_IN_FLIGHT_REQUESTS, timeout=REQUEST_TIMEOUT, controller=None):
+        self.rpc_url = rpc_url
+        self.max_batch_size = max_batch_size
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.controller = controller or ConcurrencyController(max_in_flight)
+        # Metrics are labelled by host only, since URLs can carry API keys
+        self.host = urlparse(rpc_url).hostname
+        self.session = None
+        self._ids = itertools.count(1)
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(connector=create_connector(self.max_in_flight), timeout=aiohttp.ClientTimeout(total=self.timeout))
+        self.controller.bind()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def make_request(self, method, params):
+        result = (await self.make_batch_request([(method, params)]))[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    async def make_batch_request(self, calls):
+        chunks = [calls[i : i + self.max_batch_size] for i in range(0, len(calls), self.max_batch_size)]
+        results = await asyncio.gather(*(self.post_batch(chunk) for chunk in chunks))
+        return list(itertools.chain.from_iterable(results))
+
+    async def post_batch(self, calls, on_sent=None):
+        # on_sent is called once the controller lets the request go out
+        ids = [next(self._ids) for _ in calls]
+        method = calls[0][0]
+        with TRACER.span("queued", "rpc", method=method, endpoint=self.host):
+            await self.controller.acquire()
+        if on_sent is not None:
+            on_sent()
+        with TRACER.span(method, "rpc", requests=len(calls), endpoint=self.host):
+            start = time.monotonic()
+            throttled = False
+            retry_after = None
+            error_kind = None
+            try:
+                async with self.session.post(self.rpc_url, json=build_batch_payload(ids, calls)) as response:
+                    if response.status in THROTTLE_STATUSES:
+                        throttled = True
+                        retry_after = parse_retry_after(response)
+                    response.raise_for_status()
+                    body = await response.json(content_type=None)
+                results = demultiplex_batch_response(ids, body)
+                errors = [result for result in results if isinstance(result, RPCError)]
+                throttled = any(is_throttle_error(error) for error in errors)
+                if errors:
+                    METRICS.inc("rpc_errors_total", len(errors), method=method, kind="throttle" if throttled else "rpc")
+                return results
+            except RPCError as e:
+                throttled = is_throttle_error(e)
+                error_kind = "throttle" if throttled else "rpc"
+                raise
+            except (asyncio.TimeoutError, aiohttp.ClientConnectionError):
+                throttled = True
+                error_kind = "timeout"
+                raise
+            except aiohttp.ClientResponseError:
+                error_kind = "throttle" if throttled else "http"
+                raise
+            except Exception:
+                error_kind = "other"
+                raise
+            finally:
+                latency = time.monotonic() - start
+                METRICS.inc("rpc_batches_total", method=method, endpoint=self.host)
+                METRICS.inc("rpc_requests_total", len(calls), method=method)
+                METRICS.observe("rpc_batch_latency_seconds", latency, method=method, endpoint=self.host)
+                if error_kind is not None:
+                    METRICS.inc("rpc_errors_total", len(calls), method=method, kind=error_kind)
+                await self.controller.release(latency, throttled, retry_after)
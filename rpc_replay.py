@@ -0,0 +1,130 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+import aiohttp
+from aiohttp import web
+from response_cache import request_key
+
+REPLAY_MISS_EXIT_CODE = 3
+
+
+def recording_key(item):
+    return request_key(item["method"], item.get("params", [])).hex()
+
+
+def load_recording(path):
+    # {key: (response, latency)} from a gzipped JSON-lines recording
+    recording = {}
+    with gzip.open(path, "rt") as f:
+        for line in f:
+            entry = json.loads(line)
+            recording[entry["key"]] = (entry["response"], entry["latency"])
+    return recording
+
+
+class RPCRecorder:
+    # Keeps one response per distinct request, ignoring ids. A later success
+    # replaces a recorded error, so a retried request replays the answer the run
+    # finally got.
+
+    def __init__(self):
+        self.entries = {}
+
+    def record(self, body, response_body, latency):
+        items = body if isinstance(body, list) else [body]
+        responses = response_body if isinstance(response_body, list) else [response_body]
+        by_id = {response.get("id"): response for response in responses if isinstance(response, dict)}
+        for item in items:
+            response = by_id.get(item.get("id"))
+            if response is None:
+                continue
+            key = recording_key(item)
+            previous = self.entries.get(key)
+            if previous is None or "error" in previous[0] or "result" in response:
+                self.entries[key] = ({field: value for field, value in response.items() if field in ("result", "error")}, latency)
+
+    def save(self, path):
+        with gzip.open(path + ".tmp", "wt") as f:
+            for key, (response, latency) in self.entries.items():
+                f.write(json.dumps({"key": key, "response": response, "latency": round(latency, 4)}, separators=(",", ":")) + "\n")
+        os.replace(path + ".tmp", path)
+
+
+def start_local_server(handle, port=0, on_cleanup=None):
+    # Serves handle(request) for POSTs to / from a background event loop. Returns (url, stop).
+    loop = asyncio.new_event_loop()
+    app = web.Application(client_max_size=0)
+    app.router.add_post("/", handle)
+    if on_cleanup is not None:
+        app.on_cleanup.append(on_cleanup)
+    runner = web.AppRunner(app, access_log=None)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", port)
+    loop.run_until_complete(site.start())
+    url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    def stop():
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+
+    return url, stop
+
+
+def start_recording_proxy(upstream_url, recorder):
+    # Forwards every POST to upstream_url unchanged and records the exchange.
+    # Non-200 answers (throttling, gateway errors) pass through unrecorded.
+    session = None
+
+    async def handle(request):
+        nonlocal session
+        if session is None:
+            session = aiohttp.ClientSession()
+        body = await request.json()
+        start = time.monotonic()
+        async with session.post(upstream_url, json=body) as response:
+            text = await response.text()
+            status = response.status
+            headers = {name: value for name, value in response.headers.items() if name.lower() == "retry-after"}
+        if status == 200:
+            try:
+                recorder.record(body, json.loads(text), time.monotonic() - start)
+            except ValueError:
+                pass
+        return web.Response(text=text, status=status, headers=headers, content_type="application/json")
+
+    async def close_session(app):
+        if session is not None:
+            await session.close()
+
+    return start_local_server(handle, on_cleanup=close_session)
+
+
+def start_replay_server(recording, latency=None):
+    # Local stand-in provider that answers from a recording. A batch is held for
+    # latency seconds, or by default for the slowest recorded latency among its
+    # requests. A request missing from the recording ends the process at once: an
+    # error answer would only be retried and dead-lettered, and the run would look
+    # complete without matching the recorded one.
+    async def handle(request):
+        body = await request.json()
+        items = body if isinstance(body, list) else [body]
+        responses = []
+        delay = 0.0
+        for item in items:
+            key = recording_key(item)
+            if key not in recording:
+                logging.error(f"Request not in recording, stopping replay: {item['method']} {json.dumps(item.get('params', []))[:200]}")
+                os._exit(REPLAY_MISS_EXIT_CODE)
+            response, recorded_latency = recording[key]
+            responses.append({"jsonrpc": "2.0", "id": item.get("id"), **response})
+            delay = max(delay, recorded_latency)
+        await asyncio.sleep(delay if latency is None else latency)
+        return web.json_response(responses if isinstance(body, list) else responses[0])
+
+    return start_local_server(handle)
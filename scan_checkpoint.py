@@ -0,0 +1,48 @@
+import csv
+import glob
+import json
+import os
+import re
+
+
+def scan_checkpoint_path(network_name):
+    return f"scan_checkpoint_{network_name}.json"
+
+
+def find_latest_output(network_name):
+    # Newest gmx_accounts_<network>_<block>.csv, as (block, path)
+    outputs = []
+    for path in glob.glob(f"gmx_accounts_{network_name}_*.csv"):
+        match = re.fullmatch(rf"gmx_accounts_{network_name}_(\d+)\.csv", os.path.basename(path))
+        if match:
+            outputs.append((int(match.group(1)), path))
+    return max(outputs) if outputs else None
+
+
+def read_output_accounts(path):
+    with open(path, newline="") as f:
+        return {row["account"] for row in csv.DictReader(f) if row["account"]}
+
+
+def load_scan_checkpoint(network_name):
+    # Returns (last fully scanned block, known addresses), or None for a full scan.
+    # Without a checkpoint file, the newest snapshot CSV seeds it: every holder
+    # up to its block is in the account column.
+    path = scan_checkpoint_path(network_name)
+    if os.path.exists(path):
+        with open(path) as f:
+            checkpoint = json.load(f)
+        return checkpoint["last_block"], set(checkpoint["addresses"])
+
+    latest_output = find_latest_output(network_name)
+    if latest_output is None:
+        return None
+    last_block, output_path = latest_output
+    return last_block, read_output_accounts(output_path)
+
+
+def save_scan_checkpoint(network_name, last_block, addresses):
+    path = scan_checkpoint_path(network_name)
+    with open(path + ".tmp", "w") as f:
+        json.dump({"last_block": last_block, "addresses": sorted(addresses)}, f)
+    os.replace(path + ".tmp", path)
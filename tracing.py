@@ -0,0 +1,58 @@
+import contextlib
+import heapq
+import json
+import os
+import time
+
+STAGE_LANE = 0
+
+
+class Tracer:
+    # Collects spans as Chrome trace events (chrome://tracing, Perfetto). Concurrent
+    # coroutines would overlap on one track, so every span without a fixed lane
+    # borrows the lowest free lane for its duration: the number of busy lanes at any
+    # moment is how much work was in flight, and gaps show where the pipeline
+    # serialised. Until enable() is called spans cost one attribute check.
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.origin = time.perf_counter()
+        self._free_lanes = []
+        self._lane_count = STAGE_LANE + 1
+
+    def enable(self):
+        self.enabled = True
+        self.origin = time.perf_counter()
+
+    @contextlib.contextmanager
+    def span(self, name, category, lane=None, **args):
+        if not self.enabled:
+            yield
+            return
+
+        borrowed = lane is None
+        if borrowed:
+            lane = heapq.heappop(self._free_lanes) if self._free_lanes else self._next_lane()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.events.append({"name": name, "cat": category, "ph": "X", "ts": (start - self.origin) * 1e6, "dur": (end - start) * 1e6, "pid": os.getpid(), "tid": lane, "args": args})
+            if borrowed:
+                heapq.heappush(self._free_lanes, lane)
+
+    def _next_lane(self):
+        self._lane_count += 1
+        return self._lane_count - 1
+
+    def save(self, path):
+        pid = os.getpid()
+        names = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": lane, "args": {"name": "stages" if lane == STAGE_LANE else f"lane {lane}"}} for lane in range(self._lane_count)]
+        with open(path + ".tmp", "w") as f:
+            json.dump({"traceEvents": names + self.events, "displayTimeUnit": "ms"}, f)
+        os.replace(path + ".tmp", path)
+
+
+TRACER = Tracer()